@@ -6,6 +6,9 @@ from KFACPytorch.utils.kfac_utils import (
     ComputeCovA, ComputeCovG, ComputeMatGrad)
 from KFACPytorch.utils.kfac_utils import update_running_stat
 from KFACPytorch.utils.kfac_utils import get_matrix_form_grad
+from KFACPytorch.utils.kfac_utils import unscale_grad
+from KFACPytorch.utils.kfac_utils import factors_state_dict, load_factors
+from KFACPytorch.utils.kfac_utils import FactorEigensolver
 
 
 class EKFACOptimizer(torch.optim.Optimizer):
@@ -20,7 +23,10 @@ class EKFACOptimizer(torch.optim.Optimizer):
                  TCov=10,
                  TScal=10,
                  TInv=100,
-                 batch_averaged=True):
+                 batch_averaged=True,
+                 cov_chunk_size=None,
+                 cov_spatial_stride=1,
+                 cov_dtype=torch.float32):
         if lr < 0.0:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if momentum < 0.0:
@@ -32,7 +38,9 @@ class EKFACOptimizer(torch.optim.Optimizer):
                         weight_decay=weight_decay)
         # TODO (CW): EKFAC optimizer now only support model as input
         super(EKFACOptimizer, self).__init__(model.parameters(), defaults)
-        self.CovAHandler = ComputeCovA()
+        # conv factors are accumulated in chunks of cov_chunk_size patches (see ComputeCovA)
+        self.CovAHandler = ComputeCovA(chunk_size=cov_chunk_size, spatial_stride=cov_spatial_stride,
+                                       dtype=cov_dtype, keep_activations=False)
         self.CovGHandler = ComputeCovG()
         self.MatGradHandler = ComputeMatGrad()
         self.batch_averaged = batch_averaged
@@ -47,6 +55,11 @@ class EKFACOptimizer(torch.optim.Optimizer):
 
         self.steps = 0
 
+        # loss scale of the backward pass collecting statistics (see GradScaler)
+        self.grad_scale = 1.
+
+        # the eigenbases are needed completely to estimate the scales S_l
+        self.eigensolver = FactorEigensolver()
         self.m_aa, self.m_gg = {}, {}
         self.Q_a, self.Q_g = {}, {}
         self.d_a, self.d_g = {}, {}
@@ -73,9 +86,9 @@ class EKFACOptimizer(torch.optim.Optimizer):
         # Accumulate statistics for Fisher matrices
         if self.acc_stats and self.steps % self.TCov == 0:
             gg, _ = self.CovGHandler(
-                grad_output[0].data, module, self.batch_averaged)
+                unscale_grad(grad_output[0].data, self.grad_scale), module, self.batch_averaged)
             # Initialize buffers
-            if self.steps == 0:
+            if module not in self.m_gg:
                 self.m_gg[module] = torch.diag(gg.new(gg.size(0)).fill_(1))
             update_running_stat(gg, self.m_gg[module], self.stat_decay)
 
@@ -83,7 +96,7 @@ class EKFACOptimizer(torch.optim.Optimizer):
         #     self._update_inv(module)
 
         if self.acc_stats and self.steps % self.TScal == 0 and self.steps > 0:
-            self.DS[module] = grad_output[0].data
+            self.DS[module] = unscale_grad(grad_output[0].data, self.grad_scale)
             # self._update_scale(module)
 
     def _register_modules(self):
@@ -99,21 +112,21 @@ class EKFACOptimizer(torch.optim.Optimizer):
                 print('(%s): %s' % (count, module))
                 count += 1
 
-    def _update_inv(self, m):
-        """Do eigen decomposition for computing inverse of the ~ fisher.
-        :param m: The layer
+    def _update_inv_all(self):
+        """Do eigen decomposition for computing inverse of the ~ fisher, for all layers.
+        Factors of the same size are decomposed together (see FactorEigensolver).
         :return: no returns.
         """
-        eps = 1e-10  # for numerical stability
-        self.d_a[m], self.Q_a[m] = torch.symeig(
-            self.m_aa[m], eigenvectors=True)
-        self.d_g[m], self.Q_g[m] = torch.symeig(
-            self.m_gg[m], eigenvectors=True)
-
-        self.d_a[m].mul_((self.d_a[m] > eps).float())
-        self.d_g[m].mul_((self.d_g[m] > eps).float())
-        # if self.steps != 0:
-        self.S_l[m] = self.d_g[m].unsqueeze(1) @ self.d_a[m].unsqueeze(0)
+        factors = {}
+        for m in self.modules:
+            factors[m, 'a'] = self.m_aa[m]
+            factors[m, 'g'] = self.m_gg[m]
+        results = self.eigensolver.decompose(factors)
+        for m in self.modules:
+            self.Q_a[m], self.d_a[m], _ = results[m, 'a']
+            self.Q_g[m], self.d_g[m], _ = results[m, 'g']
+            # if self.steps != 0:
+            self.S_l[m] = self.d_g[m].unsqueeze(1) @ self.d_a[m].unsqueeze(0)
 
     def _get_natural_grad(self, m, p_grad_mat, damping):
         """
@@ -215,10 +228,9 @@ class EKFACOptimizer(torch.optim.Optimizer):
         lr = group['lr']
         damping = group['damping']
         updates = {}
+        if self.steps % self.TInv == 0:
+            self._update_inv_all()
         for m in self.modules:
-            if self.steps % self.TInv == 0:
-                self._update_inv(m)
-
             if self.steps % self.TScal == 0 and self.steps > 0:
                 self._update_scale(m)
 
@@ -229,3 +241,22 @@ class EKFACOptimizer(torch.optim.Optimizer):
 
         self._step(closure)
         self.steps += 1
+
+    def state_dict(self):
+        # layer statistics are needed to resume training
+        state_dict = super(EKFACOptimizer, self).state_dict()
+        state_dict['kfac'] = {
+            'steps': self.steps,
+            'stat_decay': self.stat_decay,
+            'factors': factors_state_dict(self, ('m_aa', 'm_gg', 'Q_a', 'Q_g', 'd_a', 'd_g', 'S_l'))
+        }
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        state_dict = dict(state_dict)
+        kfac = state_dict.pop('kfac', None)
+        super(EKFACOptimizer, self).load_state_dict(state_dict)
+        if kfac is not None:
+            self.steps = kfac['steps']
+            self.stat_decay = kfac['stat_decay']
+            load_factors(self, kfac['factors'])
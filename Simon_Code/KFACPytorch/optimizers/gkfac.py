@@ -1,10 +1,12 @@
-import math
-
 import torch
 
 from KFACPytorch.utils.kfac_utils import (ComputeCovA, ComputeCovG)
 from KFACPytorch.utils.kfac_utils import update_running_stat
 from KFACPytorch.utils.kfac_utils import get_matrix_form_grad
+from KFACPytorch.utils.kfac_utils import unscale_grad
+from KFACPytorch.utils.kfac_utils import factors_state_dict, load_factors
+from KFACPytorch.utils.kfac_utils import FactorEigensolver, kron_precondition
+from KFACPytorch.utils.kfac_utils import row_sums_a, row_sums_g
 
 
 class GKFACOptimizer(torch.optim.Optimizer):
@@ -23,7 +25,12 @@ class GKFACOptimizer(torch.optim.Optimizer):
                  omega_1=1.0,
                  omega_2=1.0,
                  mode='nearest',
-                 device='cuda'):
+                 device='cuda',
+                 rank=None,
+                 lowrank_min_size=1024,
+                 cov_chunk_size=None,
+                 cov_spatial_stride=1,
+                 cov_dtype=torch.float32):
         if lr < 0.0:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if momentum < 0.0:
@@ -44,7 +51,9 @@ class GKFACOptimizer(torch.optim.Optimizer):
         self._register_modules()
 
         # utility vars
-        self.CovAHandler = ComputeCovA()
+        # conv factors are accumulated in chunks of cov_chunk_size patches (see ComputeCovA)
+        self.CovAHandler = ComputeCovA(chunk_size=cov_chunk_size, spatial_stride=cov_spatial_stride,
+                                       dtype=cov_dtype, keep_activations=False)
         self.CovGHandler = ComputeCovG()
         self.batch_averaged = batch_averaged
         self.stat_decay = 0  # stat_decay
@@ -53,11 +62,19 @@ class GKFACOptimizer(torch.optim.Optimizer):
         self.TInv = TInv
         self.steps = 0
 
+        # loss scale of the backward pass collecting statistics (see GradScaler)
+        self.grad_scale = 1.
+
         # one-level KFAC vars
+        # 'symeig' decomposes all factors with batched torch.linalg.eigh,
+        # large factors optionally with low rank (see FactorEigensolver)
         self.solver = solver
+        self.eigensolver = FactorEigensolver(rank=rank, min_size=lowrank_min_size)
         self.m_aa, self.m_gg = {}, {}
         self.Q_a, self.Q_g = {}, {}
         self.d_a, self.d_g = {}, {}
+        # eigenvalue of the complement of low-rank eigenbases
+        self.r_a, self.r_g = {}, {}
         self.Inv_a, self.Inv_g = {}, {}
 
         # two-level KFAC vars
@@ -65,40 +82,35 @@ class GKFACOptimizer(torch.optim.Optimizer):
         self.omega_2 = omega_2
         self.mode = mode
         self.nlayers = len(self.modules)
+        # only sums of the inter-layer blocks are needed,
+        # they are computed from the row sums of the inputs and gradients of every layer
         self.a = [[] for l in range(self.nlayers)]
         self.g = [[] for l in range(self.nlayers)]
         self.sum_aa = torch.zeros(self.nlayers, self.nlayers, device=device)
         self.sum_gg = torch.zeros(self.nlayers, self.nlayers, device=device)
 
     @staticmethod
-    def _downsample_multiply(a, i, j, batch_size, mode='nearest'):
-        # Get spatial dimensions of a[i] and a[j]
-        spatial_dim_i = int(math.sqrt(a[i].shape[0] / batch_size))
-        spatial_dim_j = int(math.sqrt(a[j].shape[0] / batch_size))
-        if (spatial_dim_i == spatial_dim_j):
-            cov_ij = a[i].t() @ (a[j] / batch_size)
-        elif (spatial_dim_j > spatial_dim_i):
-            a_j_dsmpl = a[j].view(batch_size, spatial_dim_j,
-                                  spatial_dim_j, -1).permute(0, 3, 1, 2)
-            a_j_dsmpl = torch.nn.functional.interpolate(
-                a_j_dsmpl, (spatial_dim_i, spatial_dim_i), mode=mode).permute(0, 2, 3, 1)
-            a_j_dsmpl = a_j_dsmpl.reshape(-1, a_j_dsmpl.size(-1))
-            cov_ij = a[i].t() @ (a_j_dsmpl / batch_size)
-        else:
-            a_i_dsmpl = a[i].view(batch_size, spatial_dim_i,
-                                  spatial_dim_i, -1).permute(0, 3, 1, 2)
-            a_i_dsmpl = torch.nn.functional.interpolate(
-                a_i_dsmpl, (spatial_dim_j, spatial_dim_j), mode=mode).permute(0, 2, 3, 1)
-            a_i_dsmpl = a_i_dsmpl.reshape(-1, a_i_dsmpl.size(-1))
-            cov_ij = a_i_dsmpl.t() @ (a[j] / batch_size)
-        return cov_ij
+    def _downsample_multiply(a, i, j, mode='nearest'):
+        """Sum of the inter-layer covariance a[i].t() @ a[j] / batch_size from the row sums of both layers.
+        The larger feature map is downsampled to the size of the smaller one.
+        :param a: row sums of the layers (batch_size * 1 * h * w, see row_sums_a)
+        :return: scalar tensor
+        """
+        a_i, a_j = a[i], a[j]
+        size_i, size_j = a_i.shape[2:], a_j.shape[2:]
+        if size_j[0] * size_j[1] > size_i[0] * size_i[1]:
+            a_j = torch.nn.functional.interpolate(a_j, size_i, mode=mode)
+        elif size_j != size_i:
+            a_i = torch.nn.functional.interpolate(a_i, size_j, mode=mode)
+        return (a_i * a_j).sum() / a_i.size(0)
 
     def _save_input(self, module, input):
         if torch.is_grad_enabled() and self.steps % self.TCov == 0:
             # Get module index
             i = self.modules.index(module)
             with torch.no_grad():
-                aa, self.a[i] = self.CovAHandler(input[0], module)
+                aa, _ = self.CovAHandler(input[0], module)
+            self.a[i] = row_sums_a(input[0], module)
             # Initialize buffer
             if self.steps == 0:
                 self.m_aa[module] = torch.zeros_like(aa)
@@ -107,32 +119,31 @@ class GKFACOptimizer(torch.optim.Optimizer):
             # Update sums of off-diagonal blocks of A
             for j in range(i):
                 # Compute inter-layer covariances (downsample if needed)
-                new_aa = self._downsample_multiply(
-                    self.a, i, j, input[0].shape[0], self.mode)
+                new_aa = self._downsample_multiply(self.a, i, j, self.mode)
                 # Update sum
                 self.sum_aa[i][j] *= self.stat_decay
-                self.sum_aa[i][j] += (1 - self.stat_decay) * new_aa.sum()
+                self.sum_aa[i][j] += (1 - self.stat_decay) * new_aa
 
     def _save_grad_output(self, module, grad_input, grad_output):
         # Accumulate statistics for Fisher matrices
         if self.acc_stats and self.steps % self.TCov == 0:
             # Get module index
             i = self.modules.index(module)
-            gg, self.g[i] = self.CovGHandler(
-                grad_output[0], module, self.batch_averaged)
+            g = unscale_grad(grad_output[0], self.grad_scale)
+            gg, _ = self.CovGHandler(g, module, self.batch_averaged)
+            self.g[i] = row_sums_g(g, module, self.batch_averaged)
             # Initialize buffers
-            if self.steps == 0:
+            if module not in self.m_gg:
                 self.m_gg[module] = torch.zeros_like(gg)
             update_running_stat(gg, self.m_gg[module], self.stat_decay)
             self.sum_gg[i][i] = self.m_gg[module].sum()
             # Update sums of off-diagonal blocks of G
             for j in range(i, self.nlayers):
                 # Compute inter-layer covariances (downsample if needed)
-                new_gg = self._downsample_multiply(
-                    self.g, i, j, grad_output[0].shape[0], self.mode)
+                new_gg = self._downsample_multiply(self.g, i, j, self.mode)
                 # Update sum
                 self.sum_gg[i][j] *= self.stat_decay
-                self.sum_gg[i][j] += (1 - self.stat_decay) * new_gg.sum()
+                self.sum_gg[i][j] += (1 - self.stat_decay) * new_gg
 
     def _register_modules(self):
         count = 0
@@ -148,20 +159,50 @@ class GKFACOptimizer(torch.optim.Optimizer):
                 print('(%s): %s' % (count, module))
                 count += 1
 
+    def _update_inv_all(self):
+        """Refresh the preconditioner of all layers.
+        :return: no returns.
+        """
+        if self.solver == 'symeig':
+            self._update_eigen(self.modules)
+        else:
+            for m in self.modules:
+                self._update_inv(m)
+
+    def _update_eigen(self, modules):
+        """Eigen decompositions of the factors of all modules, computed together (see FactorEigensolver).
+        :param modules: the layers
+        :return: no returns.
+        """
+        factors, previous = {}, {}
+        for m in modules:
+            factors[m, 'a'] = self.m_aa[m]
+            factors[m, 'g'] = self.m_gg[m]
+            if m in self.r_a:
+                previous[m, 'a'] = (self.Q_a[m], self.d_a[m], self.r_a[m])
+            if m in self.r_g:
+                previous[m, 'g'] = (self.Q_g[m], self.d_g[m], self.r_g[m])
+        results = self.eigensolver.decompose(factors, previous)
+        for m in modules:
+            self.Q_a[m], self.d_a[m], r_a = results[m, 'a']
+            self.Q_g[m], self.d_g[m], r_g = results[m, 'g']
+            self._set_rest(self.r_a, m, r_a)
+            self._set_rest(self.r_g, m, r_g)
+
+    @staticmethod
+    def _set_rest(rest, m, value):
+        if value is None:
+            rest.pop(m, None)
+        else:
+            rest[m] = value
+
     def _update_inv(self, m):
         """Do eigen decomposition or approximate factorization for computing inverse of the ~ fisher.
         :param m: The layer
         :return: no returns.
         """
         if self.solver == 'symeig':
-            eps = 1e-10  # for numerical stability
-            self.d_a[m], self.Q_a[m] = torch.symeig(
-                self.m_aa[m], eigenvectors=True)
-            self.d_g[m], self.Q_g[m] = torch.symeig(
-                self.m_gg[m], eigenvectors=True)
-
-            self.d_a[m].mul_((self.d_a[m] > eps).float())
-            self.d_g[m].mul_((self.d_g[m] > eps).float())
+            self._update_eigen([m])
         else:
             group = self.param_groups[0]
             damping = group['damping']
@@ -196,10 +237,11 @@ class GKFACOptimizer(torch.optim.Optimizer):
         # p_grad_mat is of output_dim * input_dim
         # inv((ss')) p_grad_mat inv(aa') = [ Q_g (1/R_g) Q_g^T ] @ p_grad_mat @ [Q_a (1/R_a) Q_a^T]
         if self.solver == 'symeig':
-            v1 = self.Q_g[m].t() @ p_grad_mat @ self.Q_a[m]
-            v2 = v1 / (self.d_g[m].unsqueeze(1) *
-                       self.d_a[m].unsqueeze(0) + damping)
-            v = self.Q_g[m] @ v2 @ self.Q_a[m].t()
+            v = kron_precondition(
+                p_grad_mat,
+                self.Q_g[m], self.d_g[m], self.r_g.get(m),
+                self.Q_a[m], self.d_a[m], self.r_a.get(m),
+                damping)
         else:
             v = self.Inv_g[m] @ p_grad_mat @ self.Inv_a[m]
 
@@ -268,8 +310,7 @@ class GKFACOptimizer(torch.optim.Optimizer):
         # Update 2-level preconditioner
         if self.steps % self.TInv == 0:
             # Update layer inverses (diagonal blocks of fine Fisher)
-            for m in self.modules:
-                self._update_inv(m)
+            self._update_inv_all()
             # Recompute and invert coarse Fisher
             self._update_coarse_fisher_inv()
         # Compute fine part of natural gradient and assemble coarse rhs
@@ -297,3 +338,29 @@ class GKFACOptimizer(torch.optim.Optimizer):
         self._step(closure)
         self.steps += 1
         self.stat_decay = min(1.0 - 1.0 / (self.steps // self.TCov + 1), 0.95)
+
+    def state_dict(self):
+        # layer statistics are needed to resume training
+        state_dict = super(GKFACOptimizer, self).state_dict()
+        state_dict['kfac'] = {
+            'steps': self.steps,
+            'stat_decay': self.stat_decay,
+            'factors': factors_state_dict(self, ('m_aa', 'm_gg', 'Q_a', 'Q_g', 'd_a', 'd_g', 'r_a', 'r_g', 'Inv_a', 'Inv_g')),
+            'sum_aa': self.sum_aa,
+            'sum_gg': self.sum_gg,
+            'coarse_F_inverse': getattr(self, 'coarse_F_inverse', None)
+        }
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        state_dict = dict(state_dict)
+        kfac = state_dict.pop('kfac', None)
+        super(GKFACOptimizer, self).load_state_dict(state_dict)
+        if kfac is not None:
+            self.steps = kfac['steps']
+            self.stat_decay = kfac['stat_decay']
+            load_factors(self, kfac['factors'])
+            self.sum_aa.copy_(kfac['sum_aa'])
+            self.sum_gg.copy_(kfac['sum_gg'])
+            if kfac['coarse_F_inverse'] is not None:
+                self.coarse_F_inverse = kfac['coarse_F_inverse'].to(self.sum_gg.device)
@@ -1,10 +1,14 @@
 import math
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 
 from KFACPytorch.utils.kfac_utils import (ComputeCovA, ComputeCovG)
 from KFACPytorch.utils.kfac_utils import update_running_stat
 from KFACPytorch.utils.kfac_utils import get_matrix_form_grad
+from KFACPytorch.utils.kfac_utils import unscale_grad
+from KFACPytorch.utils.kfac_utils import factors_state_dict, load_factors
+from KFACPytorch.utils.kfac_utils import FactorEigensolver, kron_precondition
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -23,7 +27,14 @@ class KFACOptimizer(torch.optim.Optimizer):
                  TInv=100,
                  batch_averaged=True,
                  solver='symeig',
-                 print_layers=False):
+                 print_layers=False,
+                 rank=None,
+                 lowrank_min_size=1024,
+                 async_inverse=None,
+                 max_staleness=None,
+                 cov_chunk_size=None,
+                 cov_spatial_stride=1,
+                 cov_dtype=torch.float32):
         if lr < 0.0:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if momentum < 0.0:
@@ -31,6 +42,9 @@ class KFACOptimizer(torch.optim.Optimizer):
         if weight_decay < 0.0:
             raise ValueError(
                 "Invalid weight_decay value: {}".format(weight_decay))
+        if async_inverse not in (None, 'stream', 'cpu'):
+            raise ValueError(
+                "Invalid async_inverse value: {}".format(async_inverse))
 
         defaults = dict(lr=lr, momentum=momentum, damping=damping,
                         weight_decay=weight_decay)
@@ -45,7 +59,10 @@ class KFACOptimizer(torch.optim.Optimizer):
         self._register_modules()
 
         # utility vars
-        self.CovAHandler = ComputeCovA()
+        # conv factors are accumulated in chunks of cov_chunk_size patches,
+        # optionally from every cov_spatial_stride-th output position only (see ComputeCovA)
+        self.CovAHandler = ComputeCovA(chunk_size=cov_chunk_size, spatial_stride=cov_spatial_stride,
+                                       dtype=cov_dtype, keep_activations=False)
         self.CovGHandler = ComputeCovG()
         self.batch_averaged = batch_averaged
         self.stat_decay = 0  # stat_decay
@@ -54,13 +71,32 @@ class KFACOptimizer(torch.optim.Optimizer):
         self.TInv = TInv
         self.steps = 0
 
+        # loss scale of the backward pass collecting statistics (see GradScaler)
+        self.grad_scale = 1.
+
         # one-level KFAC vars
+        # 'symeig' decomposes all factors with batched torch.linalg.eigh,
+        # large factors optionally with low rank (see FactorEigensolver)
         self.solver = solver
+        self.eigensolver = FactorEigensolver(rank=rank, min_size=lowrank_min_size)
         self.m_aa, self.m_gg = {}, {}
         self.Q_a, self.Q_g = {}, {}
         self.d_a, self.d_g = {}, {}
+        # eigenvalue of the complement of low-rank eigenbases
+        self.r_a, self.r_g = {}, {}
         self.Inv_a, self.Inv_g = {}, {}
 
+        # background refresh of the preconditioner:
+        # 'stream' factorizes snapshots of the factors on a side CUDA stream,
+        # 'cpu' on the host, both in a worker thread.
+        # The previous preconditioner is used until the new one is ready,
+        # at most max_staleness steps after the refresh was started (TInv by default)
+        self.async_inverse = async_inverse
+        self.max_staleness = TInv if max_staleness is None else max_staleness
+        self._executor = None
+        self._stream = None
+        self._pending = None
+
     def _save_input(self, module, input):
         if torch.is_grad_enabled() and self.steps % self.TCov == 0:
             with torch.no_grad():
@@ -74,9 +110,9 @@ class KFACOptimizer(torch.optim.Optimizer):
         # Accumulate statistics for Fisher matrices
         if self.acc_stats and self.steps % self.TCov == 0:
             gg, _ = self.CovGHandler(
-                grad_output[0], module, self.batch_averaged)
+                unscale_grad(grad_output[0], self.grad_scale), module, self.batch_averaged)
             # Initialize buffers
-            if self.steps == 0:
+            if module not in self.m_gg:
                 self.m_gg[module] = torch.zeros_like(gg)
             update_running_stat(gg, self.m_gg[module], self.stat_decay)
 
@@ -96,35 +132,175 @@ class KFACOptimizer(torch.optim.Optimizer):
                     print('(%s): %s' % (count, module))
                 count += 1
 
+    def _update_inv_all(self):
+        """Refresh the preconditioner of all layers.
+        :return: no returns.
+        """
+        self._apply(self._factorize(self.modules, self.m_aa, self.m_gg, self._previous(self.modules),
+                                    self.param_groups[0]['damping']))
+
     def _update_inv(self, m):
         """Do eigen decomposition or approximate factorization for computing inverse of the ~ fisher.
         :param m: The layer
         :return: no returns.
         """
+        self._apply(self._factorize([m], self.m_aa, self.m_gg, self._previous([m]),
+                                    self.param_groups[0]['damping']))
+
+    def _previous(self, modules):
+        # low-rank eigenbases warm start the next decomposition
+        previous = {}
+        for m in modules:
+            if m in self.r_a:
+                previous[m, 'a'] = (self.Q_a[m], self.d_a[m], self.r_a[m])
+            if m in self.r_g:
+                previous[m, 'g'] = (self.Q_g[m], self.d_g[m], self.r_g[m])
+        return previous
+
+    @torch.no_grad()
+    def _factorize(self, modules, m_aa, m_gg, previous, damping):
+        """Preconditioner of the layers computed from the given factors, the optimizer is not changed.
+        :param modules: the layers
+        :param m_aa: factors A (or snapshots of them) of the layers
+        :param m_gg: factors G (or snapshots of them) of the layers
+        :param previous: low-rank decompositions to warm start from
+        :param damping: damping of the approximate inverses
+        :return: dict of attribute name -> {layer: tensor or None}
+        """
         if self.solver == 'symeig':
-            eps = 1e-10  # for numerical stability
-            self.d_a[m], self.Q_a[m] = torch.symeig(
-                self.m_aa[m], eigenvectors=True)
-            self.d_g[m], self.Q_g[m] = torch.symeig(
-                self.m_gg[m], eigenvectors=True)
-
-            self.d_a[m].mul_((self.d_a[m] > eps).float())
-            self.d_g[m].mul_((self.d_g[m] > eps).float())
-        else:
-            group = self.param_groups[0]
-            damping = group['damping']
-            numer = self.m_aa[m].trace() * self.m_gg[m].shape[0]
-            denom = self.m_gg[m].trace() * self.m_aa[m].shape[0]
+            # eigen decompositions of all factors, computed together (see FactorEigensolver)
+            factors = {}
+            for m in modules:
+                factors[m, 'a'] = m_aa[m]
+                factors[m, 'g'] = m_gg[m]
+            results = self.eigensolver.decompose(factors, previous)
+            update = {name: {} for name in ('Q_a', 'd_a', 'r_a', 'Q_g', 'd_g', 'r_g')}
+            for m in modules:
+                for side in ('a', 'g'):
+                    Q, d, r = results[m, side]
+                    update['Q_' + side][m] = Q
+                    update['d_' + side][m] = d
+                    update['r_' + side][m] = r
+            return update
+        update = {'Inv_a': {}, 'Inv_g': {}}
+        for m in modules:
+            numer = m_aa[m].trace() * m_gg[m].shape[0]
+            denom = m_gg[m].trace() * m_aa[m].shape[0]
             pi = numer / denom
             assert numer > 0, "trace(A) should be positive"
             assert denom > 0, "trace(G) should be positive"
             # assert pi > 0, "pi should be positive"
-            diag_a = self.m_aa[m].new_full(
-                (self.m_aa[m].shape[0],), (damping * pi)**0.5)
-            diag_g = self.m_gg[m].new_full(
-                (self.m_gg[m].shape[0],), (damping / pi)**0.5)
-            self.Inv_a[m] = (self.m_aa[m] + torch.diag(diag_a)).inverse()
-            self.Inv_g[m] = (self.m_gg[m] + torch.diag(diag_g)).inverse()
+            diag_a = m_aa[m].new_full(
+                (m_aa[m].shape[0],), (damping * pi)**0.5)
+            diag_g = m_gg[m].new_full(
+                (m_gg[m].shape[0],), (damping / pi)**0.5)
+            update['Inv_a'][m] = (m_aa[m] + torch.diag(diag_a)).inverse()
+            update['Inv_g'][m] = (m_gg[m] + torch.diag(diag_g)).inverse()
+        return update
+
+    def _apply(self, update, transfer=None):
+        """Replace the preconditioner by the result of _factorize.
+        :param transfer: applied to every tensor before it is stored
+        :return: no returns.
+        """
+        for name, values in update.items():
+            target = getattr(self, name)
+            for m, value in values.items():
+                if value is None:
+                    # no low-rank complement
+                    target.pop(m, None)
+                else:
+                    target[m] = value if transfer is None else transfer(value)
+
+    def _refresh(self):
+        """Refresh the preconditioner of all layers, in the background if enabled.
+        :return: no returns.
+        """
+        ready = all(m in (self.Q_a if self.solver == 'symeig' else self.Inv_a) for m in self.modules)
+        if self.async_inverse is None or not ready:
+            # the first preconditioner is always computed in place
+            self._collect(block=True)
+            self._update_inv_all()
+            return
+        # one refresh at a time
+        self._collect(block=True)
+        damping = self.param_groups[0]['damping']
+        previous = self._previous(self.modules)
+        if self.async_inverse == 'cpu':
+            m_aa = {m: self._host_copy(self.m_aa[m]) for m in self.modules}
+            m_gg = {m: self._host_copy(self.m_gg[m]) for m in self.modules}
+            previous = {key: tuple(self._host_copy(t) for t in value) for key, value in previous.items()}
+        else:
+            m_aa = {m: self.m_aa[m].clone() for m in self.modules}
+            m_gg = {m: self.m_gg[m].clone() for m in self.modules}
+        event = None
+        if self.m_aa[self.modules[0]].is_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        future = self._executor.submit(self._factorize_async, m_aa, m_gg, previous, damping, event)
+        self._pending = (future, self.steps)
+
+    @staticmethod
+    def _host_copy(tensor):
+        if not tensor.is_cuda:
+            return tensor.clone()
+        copy = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        copy.copy_(tensor, non_blocking=True)
+        return copy
+
+    def _factorize_async(self, m_aa, m_gg, previous, damping, event):
+        # runs in the worker thread
+        if self.async_inverse == 'cpu':
+            if event is not None:
+                event.synchronize()
+            update = self._factorize(self.modules, m_aa, m_gg, previous, damping)
+            if event is None:
+                return update
+            # pinned, so that the results are copied to the device without blocking
+            return {name: {m: value.pin_memory() if value is not None else None
+                           for m, value in values.items()}
+                    for name, values in update.items()}
+        device = self.m_aa[self.modules[0]].device
+        if event is None:
+            return self._factorize(self.modules, m_aa, m_gg, previous, damping)
+        with torch.cuda.device(device):
+            if self._stream is None:
+                self._stream = torch.cuda.Stream()
+            # the snapshots are taken on the stream of the training step
+            self._stream.wait_event(event)
+            with torch.cuda.stream(self._stream):
+                update = self._factorize(self.modules, m_aa, m_gg, previous, damping)
+            self._stream.synchronize()
+        return update
+
+    def _collect(self, block=False):
+        """Swap in the preconditioner of a background refresh if it is done
+        (or has become too stale to wait any longer).
+        :param block: wait for a pending refresh
+        :return: no returns.
+        """
+        if self._pending is None:
+            return
+        future, started = self._pending
+        if not (block or future.done() or self.steps - started >= self.max_staleness):
+            return
+        self._pending = None
+        update = future.result()
+        device = self.m_aa[self.modules[0]].device
+        if self.async_inverse == 'cpu':
+            self._apply(update, lambda t: t.to(device, non_blocking=True))
+        elif device.type == 'cuda':
+            # allocated on the side stream, keep the memory until the training step is done with it
+            self._apply(update, lambda t: self._record_stream(t, torch.cuda.current_stream(device)))
+        else:
+            self._apply(update)
+
+    @staticmethod
+    def _record_stream(tensor, stream):
+        tensor.record_stream(stream)
+        return tensor
 
     def _get_natural_grad(self, m, p_grad_mat, damping):
         """
@@ -135,10 +311,11 @@ class KFACOptimizer(torch.optim.Optimizer):
         # p_grad_mat is of output_dim * input_dim
         # inv((ss')) p_grad_mat inv(aa') = [ Q_g (1/R_g) Q_g^T ] @ p_grad_mat @ [Q_a (1/R_a) Q_a^T]
         if self.solver == 'symeig':
-            v1 = self.Q_g[m].t() @ p_grad_mat @ self.Q_a[m]
-            v2 = v1 / (self.d_g[m].unsqueeze(1) *
-                       self.d_a[m].unsqueeze(0) + damping)
-            v = self.Q_g[m] @ v2 @ self.Q_a[m].t()
+            v = kron_precondition(
+                p_grad_mat,
+                self.Q_g[m], self.d_g[m], self.r_g.get(m),
+                self.Q_a[m], self.d_a[m], self.r_a.get(m),
+                damping)
         else:
             v = self.Inv_g[m] @ p_grad_mat @ self.Inv_a[m]
 
@@ -205,9 +382,10 @@ class KFACOptimizer(torch.optim.Optimizer):
         lr = group['lr']
         damping = group['damping']
         updates = {}
+        if self.steps % self.TInv == 0:
+            self._refresh()
+        self._collect()
         for m in self.modules:
-            if self.steps % self.TInv == 0:
-                self._update_inv(m)
             p_grad_mat = get_matrix_form_grad(m)
             v = self._get_natural_grad(m, p_grad_mat, damping)
             updates[m] = v
@@ -216,3 +394,24 @@ class KFACOptimizer(torch.optim.Optimizer):
         self._step(closure)
         self.steps += 1
         self.stat_decay = min(1.0 - 1.0 / (self.steps // self.TCov + 1), 0.95)
+
+    def state_dict(self):
+        # layer statistics are needed to resume training
+        state_dict = super(KFACOptimizer, self).state_dict()
+        state_dict['kfac'] = {
+            'steps': self.steps,
+            'stat_decay': self.stat_decay,
+            'factors': factors_state_dict(self, ('m_aa', 'm_gg', 'Q_a', 'Q_g', 'd_a', 'd_g', 'r_a', 'r_g', 'Inv_a', 'Inv_g'))
+        }
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        state_dict = dict(state_dict)
+        kfac = state_dict.pop('kfac', None)
+        super(KFACOptimizer, self).load_state_dict(state_dict)
+        # a refresh started before loading is outdated
+        self._collect(block=True)
+        if kfac is not None:
+            self.steps = kfac['steps']
+            self.stat_decay = kfac['stat_decay']
+            load_factors(self, kfac['factors'])
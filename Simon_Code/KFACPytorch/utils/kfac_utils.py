@@ -50,16 +50,162 @@ def update_running_stat(aa, m_aa, stat_decay):
     m_aa *= (1 - stat_decay)
 
 
+def unscale_grad(g, grad_scale):
+    """
+    :param g: gradient w.r.t. the output of a layer
+    :param grad_scale: loss scale the gradient was computed with (e.g. of a GradScaler)
+    :return: the unscaled gradient
+    """
+    if grad_scale == 1:
+        return g
+    return g.float() / grad_scale
+
+
+def kron_precondition(p_grad_mat, Q_g, d_g, r_g, Q_a, d_a, r_a, damping):
+    """
+    Apply inv(G x A + damping) to the gradient using eigen decompositions of the factors.
+    :param p_grad_mat: the gradients in matrix form (output_dim * input_dim)
+    :param Q_g, d_g: eigenvectors and eigenvalues of G
+    :param r_g: eigenvalue assumed for the complement of Q_g (low-rank decomposition), None if Q_g is complete
+    :param Q_a, d_a, r_a: same for A
+    :param damping: damping added to the eigenvalues of the Kronecker product
+    :return: the preconditioned gradient in matrix form
+    """
+    pa = p_grad_mat @ Q_a
+    v1 = Q_g.t() @ pa
+    v = Q_g @ (v1 / (d_g.unsqueeze(1) * d_a.unsqueeze(0) + damping)) @ Q_a.t()
+    if r_a is not None:
+        # component of the gradient outside of span(Q_a)
+        p_rest_a = p_grad_mat - pa @ Q_a.t()
+        v += Q_g @ ((Q_g.t() @ p_rest_a) / (d_g.unsqueeze(1) * r_a + damping))
+    if r_g is not None:
+        p_rest_g = p_grad_mat - Q_g @ (Q_g.t() @ p_grad_mat)
+        v += ((p_rest_g @ Q_a) / (r_g * d_a.unsqueeze(0) + damping)) @ Q_a.t()
+        if r_a is not None:
+            v += (p_rest_g - (p_rest_g @ Q_a) @ Q_a.t()) / (r_g * r_a + damping)
+    return v
+
+
+class FactorEigensolver:
+    """
+    Eigen decompositions of the Kronecker factors of all layers at once.
+    Factors of the same size are stacked and decomposed with batched torch.linalg.eigh.
+    With a rank, factors of at least min_size rows only get their top eigenpairs
+    by randomized subspace iteration, warm started from the basis of the last refresh.
+    The remaining eigenvalues are replaced by their mean.
+    """
+
+    def __init__(self, eps=1e-10, rank=None, min_size=1024, oversample=16, iterations=1):
+        """
+        :param eps: eigenvalues below are set to zero
+        :param rank: eigenpairs kept for large factors, None decomposes all factors exactly
+        :param min_size: size from which factors are decomposed with low rank
+        :param oversample: additional random directions of the subspace iteration
+        :param iterations: subspace iterations of a warm-started refresh (a cold start runs two more)
+        """
+        self.eps = eps
+        self.rank = rank
+        self.min_size = min_size
+        self.oversample = oversample
+        self.iterations = iterations
+
+    def _is_lowrank(self, size):
+        return self.rank is not None and self.rank < size and size >= self.min_size
+
+    def _lowrank_eigh(self, factors, warm):
+        n = factors.shape[-1]
+        iterations = self.iterations
+        sketch = factors.new_empty(factors.shape[0], n, min(self.oversample, n - self.rank)).normal_()
+        if warm is None:
+            sketch = torch.cat([sketch, factors.new_empty(factors.shape[0], n, self.rank).normal_()], dim=-1)
+            iterations += 2
+        else:
+            sketch = torch.cat([warm, sketch], dim=-1)
+        Q = sketch
+        for _ in range(iterations):
+            Q, _ = torch.linalg.qr(factors @ Q)
+        # Rayleigh-Ritz in the subspace
+        d, W = torch.linalg.eigh(Q.transpose(-1, -2) @ factors @ Q)
+        d, W = d[..., -self.rank:], W[..., -self.rank:]
+        trace = factors.diagonal(dim1=-2, dim2=-1).sum(-1)
+        rest = ((trace - d.sum(-1)) / (n - self.rank)).clamp(min=0)
+        return d, Q @ W, rest
+
+    @torch.no_grad()
+    def decompose(self, factors, previous=None):
+        """
+        :param factors: dict of symmetric factors
+        :param previous: optional dict of (Q, d, r) of the last refresh with the same keys,
+            used to warm start low-rank decompositions
+        :return: dict of (Q, d, r) with eigenvalues in ascending order,
+            r is the eigenvalue of the complement of Q (None for exact decompositions)
+        """
+        previous = previous or {}
+        groups = {}
+        for key, factor in factors.items():
+            groups.setdefault((factor.shape[0], factor.dtype, factor.device), []).append(key)
+        results = {}
+        for (size, _, _), keys in groups.items():
+            batch = torch.stack([factors[key].float() for key in keys])
+            rest = None
+            if self._is_lowrank(size):
+                warm = [previous.get(key) for key in keys]
+                if all(w is not None and w[2] is not None and w[0].shape[-1] == self.rank for w in warm):
+                    warm = torch.stack([w[0] for w in warm])
+                else:
+                    warm = None
+                d, Q, rest = self._lowrank_eigh(batch, warm)
+                rest = rest * (rest > self.eps)
+            else:
+                d, Q = torch.linalg.eigh(batch)
+            d = d * (d > self.eps)
+            for index, key in enumerate(keys):
+                results[key] = (Q[index], d[index], None if rest is None else rest[index])
+        return results
+
+
+def factors_state_dict(optimizer, names):
+    """
+    :param optimizer: a KFAC optimizer with per-layer statistics in dicts keyed by module
+    :param names: attributes of the dicts to store
+    :return: the statistics keyed by the position of the layer in optimizer.modules
+    """
+    return {
+        name: {
+            index: getattr(optimizer, name)[m]
+            for index, m in enumerate(optimizer.modules)
+            if m in getattr(optimizer, name)
+        }
+        for name in names
+    }
+
+
+def load_factors(optimizer, factors):
+    """
+    :param optimizer: a KFAC optimizer with per-layer statistics in dicts keyed by module
+    :param factors: statistics returned by factors_state_dict
+    :return: no returns.
+    """
+    for name, values in factors.items():
+        stats = getattr(optimizer, name)
+        for index, value in values.items():
+            m = optimizer.modules[index]
+            stats[m] = value.to(m.weight.device)
+
+
 class ComputeMatGrad:
 
     @classmethod
     def __call__(cls, input, grad_output, layer):
-        if isinstance(layer, nn.Linear):
-            grad = cls.linear(input, grad_output, layer)
-        elif isinstance(layer, nn.Conv2d):
-            grad = cls.conv2d(input, grad_output, layer)
-        else:
-            raise NotImplementedError
+        # statistics are always computed in fp32, also under autocast
+        with torch.autocast(input.device.type, enabled=False):
+            input, grad_output = input.float(), grad_output.float()
+            if isinstance(layer, nn.Linear):
+                grad = cls.linear(input, grad_output, layer)
+            elif isinstance(layer, nn.Conv2d):
+                grad = cls.conv2d(input, grad_output, layer)
+            else:
+                raise NotImplementedError
         return grad
 
     @staticmethod
@@ -100,21 +246,42 @@ class ComputeMatGrad:
 
 
 class ComputeCovA:
+    """
+    Factor A of a layer, E[a a^T] of its inputs (with a constant for the bias).
+
+    For conv layers the patch matrix (batch_size * out_h * out_w rows of in_c*kh*kw) is never
+    built as a whole unless keep_activations: patches are extracted and multiplied in chunks,
+    1x1 kernels are read from the input without unfolding.
+    :param chunk_size: rows of the patch matrix processed at once, None for all
+    :param spatial_stride: only every n-th output position (along both axes) of conv layers
+        contributes, the factor is rescaled to estimate the one of all positions
+    :param dtype: dtype of the products (e.g. torch.float16 on GPU), they are accumulated in fp32
+    :param keep_activations: also return the (scaled) inputs, e.g. for the inter-layer blocks of GKFAC
+    """
 
-    @classmethod
-    def compute_cov_a(cls, a, layer):
-        return cls.__call__(a, layer)
-
-    @classmethod
-    def __call__(cls, a, layer):
-        if isinstance(layer, nn.Linear):
-            (cov_a, a) = cls.linear(a, layer)
-        elif isinstance(layer, nn.Conv2d):
-            (cov_a, a) = cls.conv2d(a, layer)
-        else:
-            # FIXME(CW): for extension to other layers.
-            # raise NotImplementedError
-            cov_a = None
+    def __init__(self, chunk_size=None, spatial_stride=1, dtype=torch.float32, keep_activations=True):
+        self.chunk_size = chunk_size
+        self.spatial_stride = spatial_stride
+        self.dtype = dtype
+        self.keep_activations = keep_activations
+
+    def compute_cov_a(self, a, layer):
+        return self(a, layer)
+
+    def __call__(self, a, layer):
+        # statistics are always computed in fp32, also under autocast
+        with torch.autocast(a.device.type, enabled=False):
+            if isinstance(layer, nn.Linear):
+                (cov_a, a) = self.linear(a.float(), layer)
+            elif isinstance(layer, nn.Conv2d):
+                if self.keep_activations:
+                    (cov_a, a) = self.conv2d(a.float(), layer)
+                else:
+                    (cov_a, a) = (self.conv2d_chunked(a, layer), None)
+            else:
+                # FIXME(CW): for extension to other layers.
+                # raise NotImplementedError
+                cov_a = None
 
         return (cov_a, a)
 
@@ -131,6 +298,44 @@ class ComputeCovA:
         # FIXME(CW): do we need to divide the output feature map's size?
         return (a.t() @ (a / batch_size), a)
 
+    def conv2d_chunked(self, a, layer):
+        """
+        Same factor as conv2d, accumulated over chunks of samples.
+        :param a: batch_size * in_c * in_h * in_w
+        :return: (in_c*kh*kw + [1 if with bias]) ** 2
+        """
+        batch_size = a.size(0)
+        out_h = (a.size(2) + 2 * layer.padding[0] - layer.kernel_size[0]) // layer.stride[0] + 1
+        out_w = (a.size(3) + 2 * layer.padding[1] - layer.kernel_size[1]) // layer.stride[1] + 1
+        spatial_size = out_h * out_w
+        stride = (layer.stride[0] * self.spatial_stride, layer.stride[1] * self.spatial_stride)
+        positions = ((out_h - 1) // self.spatial_stride + 1) * ((out_w - 1) // self.spatial_stride + 1)
+        # a.t() @ a / (spatial_size ** 2 * batch_size), with the sampled positions standing in for all.
+        # The patches are scaled before the product so that fp16 products do not overflow
+        scale = (1. / (spatial_size * positions * batch_size)) ** 0.5
+        samples = batch_size if self.chunk_size is None else max(1, self.chunk_size // positions)
+        dim = a.size(1) * layer.kernel_size[0] * layer.kernel_size[1]
+        cov_a = a.new_zeros(dim, dim, dtype=torch.float32)
+        sum_a = a.new_zeros(dim, dtype=torch.float32)
+        for chunk in a.split(samples):
+            if layer.kernel_size == (1, 1) and layer.padding == (0, 0):
+                # the patches are the (strided) input itself
+                chunk = chunk[:, :, ::stride[0], ::stride[1]].permute(0, 2, 3, 1)
+            else:
+                chunk = _extract_patches(chunk, layer.kernel_size, stride, layer.padding)
+            chunk = chunk.reshape(-1, dim).to(self.dtype) * scale
+            cov_a += (chunk.t() @ chunk).float()
+            if layer.bias is not None:
+                sum_a += chunk.sum(0, dtype=torch.float32)
+        if layer.bias is None:
+            return cov_a
+        # block of the constant input of the bias
+        corner = sum_a.new_full((1, 1), batch_size * positions * scale ** 2)
+        return torch.cat([
+            torch.cat([cov_a, sum_a.unsqueeze(1) * scale], 1),
+            torch.cat([sum_a.unsqueeze(0) * scale, corner], 1)
+        ], 0)
+
     @staticmethod
     def linear(a, layer):
         # a: batch_size * in_dim
@@ -155,12 +360,15 @@ class ComputeCovG:
 
     @classmethod
     def __call__(cls, g, layer, batch_averaged):
-        if isinstance(layer, nn.Conv2d):
-            (cov_g, g) = cls.conv2d(g, layer, batch_averaged)
-        elif isinstance(layer, nn.Linear):
-            (cov_g, g) = cls.linear(g, layer, batch_averaged)
-        else:
-            cov_g = None
+        # statistics are always computed in fp32, also under autocast
+        with torch.autocast(g.device.type, enabled=False):
+            g = g.float()
+            if isinstance(layer, nn.Conv2d):
+                (cov_g, g) = cls.conv2d(g, layer, batch_averaged)
+            elif isinstance(layer, nn.Linear):
+                (cov_g, g) = cls.linear(g, layer, batch_averaged)
+            else:
+                cov_g = None
 
         return (cov_g, g)
 
@@ -198,6 +406,105 @@ class ComputeCovG:
 
 
 
+class FisherSampler:
+    """
+    Backward passes collecting the gradient statistics of the (E/G)KFAC optimizers
+    from the outputs of a forward pass, targets are sampled on the device of the outputs.
+    :param fisher: 'sampled' draws targets from the predicted distribution (true Fisher),
+        'empirical' uses the training targets, i.e. the statistics are collected
+        in the backward pass of the training loss
+    :param samples: targets drawn per input ('sampled' only), every draw is a backward pass
+        through the same graph and the statistics of all draws are averaged
+    :param generator: torch.Generator on the device of the outputs
+    """
+
+    def __init__(self, fisher='sampled', samples=1, generator=None):
+        if fisher not in ('sampled', 'empirical'):
+            raise ValueError("Invalid fisher value: {}".format(fisher))
+        if samples < 1:
+            raise ValueError("Invalid number of samples: {}".format(samples))
+        self.fisher = fisher
+        self.samples = samples
+        self.generator = generator
+
+    @property
+    def empirical(self):
+        return self.fisher == 'empirical'
+
+    def sample(self, output):
+        """
+        :param output: batch_size * n_classes logits
+        :return: samples * batch_size sampled targets
+        """
+        with torch.no_grad():
+            probs = F.softmax(output.detach().float(), dim=1)
+            return torch.multinomial(probs, self.samples, replacement=True, generator=self.generator).t()
+
+    def backward(self, optimizer, criterion, output, scaler=None):
+        """
+        Backward passes of the losses of sampled targets, the graph of output is retained.
+        The running statistics are updated once per pass, weighted such that
+        all passes together count as one update with the stat_decay of the optimizer.
+        :param scaler: GradScaler the losses are scaled with (see grad_scale of the optimizers)
+        :return: no returns.
+        """
+        stat_decay = optimizer.stat_decay
+        optimizer.acc_stats = True
+        try:
+            for k, target in enumerate(self.sample(output)):
+                # weight of the statistics before and after this pass
+                before = 1 - (self.samples - k) * (1 - stat_decay) / self.samples
+                after = 1 - (self.samples - k - 1) * (1 - stat_decay) / self.samples
+                optimizer.stat_decay = before / after
+                loss = criterion(output.float(), target)
+                if scaler is not None:
+                    loss = scaler.scale(loss)
+                loss.backward(retain_graph=True)
+        finally:
+            optimizer.acc_stats = False
+            optimizer.stat_decay = stat_decay
+
+
+def row_sums_a(a, layer):
+    """
+    Row sums of the inputs ComputeCovA returns with keep_activations, without building them.
+    For conv layers the patches are summed by a convolution of the channel sum with a kernel of ones.
+    :param a: batch_size * in_dim or batch_size * in_c * in_h * in_w
+    :param layer: the corresponding layer
+    :return: batch_size * 1 * out_h * out_w (1 * 1 for Linear layers)
+    """
+    with torch.no_grad(), torch.autocast(a.device.type, enabled=False):
+        a = a.float()
+        if isinstance(layer, nn.Conv2d):
+            a = F.conv2d(a.sum(1, keepdim=True), a.new_ones(1, 1, *layer.kernel_size),
+                         stride=layer.stride, padding=layer.padding)
+            spatial_size = a.size(2) * a.size(3)
+        else:
+            a = a.sum(1).view(-1, 1, 1, 1)
+            spatial_size = 1
+        if layer.bias is not None:
+            a = a + 1
+        return a / spatial_size
+
+
+def row_sums_g(g, layer, batch_averaged):
+    """
+    Row sums of the gradients ComputeCovG returns.
+    :param g: gradient w.r.t. the output of the layer
+    :return: batch_size * 1 * out_h * out_w (1 * 1 for Linear layers)
+    """
+    with torch.no_grad(), torch.autocast(g.device.type, enabled=False):
+        g = g.float()
+        batch_size = g.size(0)
+        if isinstance(layer, nn.Conv2d):
+            g = g.sum(1, keepdim=True) * (g.size(2) * g.size(3))
+        else:
+            g = g.sum(1).view(-1, 1, 1, 1)
+        if batch_averaged:
+            g = g * batch_size
+        return g
+
+
 if __name__ == '__main__':
     def test_ComputeCovA():
         pass
@@ -0,0 +1,142 @@
+import argparse
+import math
+import time
+import torch
+from models import (
+    Cnn10,
+    Cnn14
+)
+from KFACPytorch import GKFACOptimizer
+from KFACPytorch.utils.kfac_utils import (
+    ComputeCovA,
+    update_running_stat,
+    unscale_grad
+)
+from training import train_step_kfac
+
+
+class FullActivationsGKFAC(GKFACOptimizer):
+    r"""GKFAC computing the inter-layer blocks like it used to.
+
+    The inputs and gradients of all layers are kept
+    and every pair of layers is multiplied (after downsampling) in full,
+    only square feature maps are supported.
+    """
+
+    def __init__(self, model, **kwargs):
+        super().__init__(model, **kwargs)
+        self.CovAHandler = ComputeCovA()
+
+    @staticmethod
+    def _full_multiply(a, i, j, batch_size, mode='nearest'):
+        spatial_dim_i = int(math.sqrt(a[i].shape[0] / batch_size))
+        spatial_dim_j = int(math.sqrt(a[j].shape[0] / batch_size))
+        if spatial_dim_i == spatial_dim_j:
+            return a[i].t() @ (a[j] / batch_size)
+        if spatial_dim_j > spatial_dim_i:
+            a_j = a[j].view(batch_size, spatial_dim_j, spatial_dim_j, -1).permute(0, 3, 1, 2)
+            a_j = torch.nn.functional.interpolate(
+                a_j, (spatial_dim_i, spatial_dim_i), mode=mode).permute(0, 2, 3, 1)
+            return a[i].t() @ (a_j.reshape(-1, a_j.size(-1)) / batch_size)
+        a_i = a[i].view(batch_size, spatial_dim_i, spatial_dim_i, -1).permute(0, 3, 1, 2)
+        a_i = torch.nn.functional.interpolate(
+            a_i, (spatial_dim_j, spatial_dim_j), mode=mode).permute(0, 2, 3, 1)
+        return a_i.reshape(-1, a_i.size(-1)).t() @ (a[j] / batch_size)
+
+    def _save_input(self, module, input):
+        if torch.is_grad_enabled() and self.steps % self.TCov == 0:
+            i = self.modules.index(module)
+            with torch.no_grad():
+                aa, self.a[i] = self.CovAHandler(input[0], module)
+            if self.steps == 0:
+                self.m_aa[module] = torch.zeros_like(aa)
+            update_running_stat(aa, self.m_aa[module], self.stat_decay)
+            self.sum_aa[i][i] = self.m_aa[module].sum()
+            for j in range(i):
+                new_aa = self._full_multiply(self.a, i, j, input[0].shape[0], self.mode)
+                self.sum_aa[i][j] *= self.stat_decay
+                self.sum_aa[i][j] += (1 - self.stat_decay) * new_aa.sum()
+
+    def _save_grad_output(self, module, grad_input, grad_output):
+        if self.acc_stats and self.steps % self.TCov == 0:
+            i = self.modules.index(module)
+            gg, self.g[i] = self.CovGHandler(
+                unscale_grad(grad_output[0], self.grad_scale), module, self.batch_averaged)
+            if self.steps == 0:
+                self.m_gg[module] = torch.zeros_like(gg)
+            update_running_stat(gg, self.m_gg[module], self.stat_decay)
+            self.sum_gg[i][i] = self.m_gg[module].sum()
+            for j in range(i, self.nlayers):
+                new_gg = self._full_multiply(self.g, i, j, grad_output[0].shape[0], self.mode)
+                self.sum_gg[i][j] *= self.stat_decay
+                self.sum_gg[i][j] += (1 - self.stat_decay) * new_gg.sum()
+
+
+def run_steps(model, optimizer, criterion, batches, device):
+    r"""Train on ``batches`` and return the number of steps per second."""
+    torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for index, (features, targets) in enumerate(batches):
+        train_step_kfac(model, optimizer, criterion, features, targets, device, 1, index)
+    torch.cuda.synchronize(device)
+    return len(batches) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Step rate of GKFAC with full and summarized inter-layer blocks')
+    parser.add_argument(
+        '--device',
+        default='cuda:0'
+    )
+    parser.add_argument(
+        '--approach',
+        default='cnn14',
+        choices=['cnn10', 'cnn14']
+    )
+    parser.add_argument(
+        '--input-shape',
+        default='1x64x64',
+        help='Shape of one sample, the full version needs square inputs, e.g. 3x64x64 for CIFAR10'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=16
+    )
+    parser.add_argument(
+        '--steps',
+        type=int,
+        default=20
+    )
+    parser.add_argument(
+        '--warmup',
+        type=int,
+        default=2
+    )
+    args = parser.parse_args()
+
+    device = args.device
+    shape = tuple(int(x) for x in args.input_shape.split('x'))
+    model_class = Cnn10 if args.approach == 'cnn10' else Cnn14
+    criterion = torch.nn.CrossEntropyLoss()
+    batches = [
+        (
+            torch.randn(args.batch_size, *shape, device=device),
+            torch.randint(0, 10, (args.batch_size,), device=device)
+        )
+        for _ in range(args.warmup + args.steps)
+    ]
+
+    results = {}
+    for name, optimizer_class in [('full', FullActivationsGKFAC), ('row sums', GKFACOptimizer)]:
+        torch.manual_seed(0)
+        model = model_class(output_dim=10, in_channels=shape[0]).to(device)
+        model.train()
+        # statistics every step, the preconditioner is only computed in the first one
+        optimizer = optimizer_class(model, lr=1e-4, TCov=1, TInv=len(batches), device=device)
+        run_steps(model, optimizer, criterion, batches[:args.warmup], device)
+        torch.cuda.reset_peak_memory_stats(device)
+        results[name] = run_steps(model, optimizer, criterion, batches[args.warmup:], device)
+        print(f'{name}:\t{results[name]:.2f} steps/s, '
+              f'peak memory {torch.cuda.max_memory_allocated(device) / 2 ** 30:.2f} GiB')
+    print(f'speedup:\t{results["row sums"] / results["full"]:.3f}x')
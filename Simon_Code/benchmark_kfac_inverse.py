@@ -0,0 +1,90 @@
+import argparse
+import time
+import torch
+from models import (
+    Cnn10,
+    Cnn14
+)
+from KFACPytorch import KFACOptimizer
+from KFACPytorch.utils.kfac_utils import FactorEigensolver
+from training import train_step_kfac
+
+
+def time_refresh(refresh, device, repeats):
+    r"""Mean time in seconds of ``refresh()``."""
+    refresh()
+    torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        refresh()
+    torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Time of a KFAC preconditioner refresh')
+    parser.add_argument(
+        '--device',
+        default='cuda:0'
+    )
+    parser.add_argument(
+        '--approach',
+        default='cnn14',
+        choices=['cnn10', 'cnn14']
+    )
+    parser.add_argument(
+        '--input-shape',
+        default='1x1001x64',
+        help='Shape of one sample, e.g. 3x64x64 for CIFAR10'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=16
+    )
+    parser.add_argument(
+        '--rank',
+        type=int,
+        default=256,
+        help='Eigenpairs kept for large factors by the low-rank solver'
+    )
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=5
+    )
+    args = parser.parse_args()
+
+    device = args.device
+    shape = tuple(int(x) for x in args.input_shape.split('x'))
+    model_class = Cnn10 if args.approach == 'cnn10' else Cnn14
+    model = model_class(output_dim=10, in_channels=shape[0]).to(device)
+    model.train()
+    optimizer = KFACOptimizer(model, lr=1e-4)
+    # one step fills the factors of all layers
+    train_step_kfac(
+        model,
+        optimizer,
+        torch.nn.CrossEntropyLoss(),
+        torch.randn(args.batch_size, *shape, device=device),
+        torch.randint(0, 10, (args.batch_size,), device=device),
+        device,
+        1,
+        1
+    )
+    factors = [optimizer.m_aa[m] for m in optimizer.modules] + \
+        [optimizer.m_gg[m] for m in optimizer.modules]
+    print(f'{len(factors)} factors, largest {max(f.shape[0] for f in factors)} rows')
+
+    def per_layer():
+        for factor in factors:
+            torch.linalg.eigh(factor)
+
+    results = {'per-layer eigh': time_refresh(per_layer, device, args.repeats)}
+    optimizer.eigensolver = FactorEigensolver()
+    results['batched eigh'] = time_refresh(optimizer._update_inv_all, device, args.repeats)
+    optimizer.eigensolver = FactorEigensolver(rank=args.rank)
+    # repeated refreshes are warm started
+    results[f'low rank ({args.rank})'] = time_refresh(optimizer._update_inv_all, device, args.repeats)
+    for name, seconds in results.items():
+        print(f'{name}:\t{seconds * 1000:.1f} ms')
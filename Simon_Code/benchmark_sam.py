@@ -0,0 +1,107 @@
+import argparse
+import time
+import torch
+from models import (
+    Cnn10,
+    Cnn14
+)
+from sam import (
+    SAM,
+    LookSAM,
+    ESAM
+)
+from training import (
+    train_step_normal,
+    train_step_SAM
+)
+
+
+def run_steps(model, optimizer, criterion, batches, device, train_step):
+    r"""Train on ``batches`` and return the number of steps per second."""
+    torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for features, targets in batches:
+        train_step(model, optimizer, criterion, features, targets, device)
+    torch.cuda.synchronize(device)
+    return len(batches) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Step rate of SAM compared to its base optimizer')
+    parser.add_argument(
+        '--device',
+        default='cuda:0'
+    )
+    parser.add_argument(
+        '--approach',
+        default='cnn14',
+        choices=['cnn10', 'cnn14']
+    )
+    parser.add_argument(
+        '--input-shape',
+        default='1x1001x64',
+        help='Shape of one sample, e.g. 3x64x64 for CIFAR10'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=32
+    )
+    parser.add_argument(
+        '--steps',
+        type=int,
+        default=100
+    )
+    parser.add_argument(
+        '--warmup',
+        type=int,
+        default=10
+    )
+    args = parser.parse_args()
+
+    device = args.device
+    shape = tuple(int(x) for x in args.input_shape.split('x'))
+    model_class = Cnn10 if args.approach == 'cnn10' else Cnn14
+    model = model_class(output_dim=10, in_channels=shape[0]).to(device)
+    model.train()
+    criterion = torch.nn.CrossEntropyLoss()
+    batches = [
+        (
+            torch.randn(args.batch_size, *shape, device=device),
+            torch.randint(0, 10, (args.batch_size,), device=device)
+        )
+        for _ in range(args.steps)
+    ]
+
+    optimizers = {
+        'SGD': (
+            torch.optim.SGD(model.parameters(), lr=1e-4, momentum=0.9),
+            train_step_normal
+        ),
+        'SAM': (
+            SAM(model.parameters(), torch.optim.SGD, lr=1e-4, momentum=0.9),
+            train_step_SAM
+        ),
+        'SAM (store perturbation)': (
+            SAM(model.parameters(), torch.optim.SGD, lr=1e-4, momentum=0.9, store_perturbation=True),
+            train_step_SAM
+        ),
+        'LookSAM': (
+            LookSAM(model.parameters(), torch.optim.SGD, lr=1e-4, momentum=0.9),
+            train_step_SAM
+        ),
+        'ESAM': (
+            ESAM(model.parameters(), torch.optim.SGD, lr=1e-4, momentum=0.9),
+            train_step_SAM
+        )
+    }
+    results = {}
+    for name, (optimizer, train_step) in optimizers.items():
+        run_steps(model, optimizer, criterion, batches[:args.warmup], device, train_step)
+        results[name] = run_steps(model, optimizer, criterion, batches, device, train_step)
+        print(f'{name}:\t{results[name]:.2f} steps/s')
+        if isinstance(optimizer, SAM):
+            print(f'{name} passes per step:\t{optimizer.cost():.3f}')
+    for name in list(optimizers)[1:]:
+        # plain SAM needs two forward-backward passes per step, about 2x
+        print(f'{name} overhead:\t{results["SGD"] / results[name]:.3f}x')
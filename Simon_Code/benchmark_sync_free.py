@@ -0,0 +1,101 @@
+import argparse
+import time
+import torch
+from models import (
+    Cnn10,
+    Cnn14
+)
+from training import train_step_normal
+from utils import LossMeter
+
+
+def run_steps(model, optimizer, criterion, batches, device, sync_free, log_interval):
+    r"""Train on ``batches`` and return the number of steps per second.
+
+    Without ``sync_free`` every step checks the features for NaNs
+    and reads the loss on the host like the training loop used to.
+    """
+    meter = LossMeter(device)
+    torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for index, (features, targets) in enumerate(batches):
+        if sync_free:
+            meter.check_features(features)
+        elif (features != features).sum():
+            raise ValueError(features)
+        loss = train_step_normal(
+            model, optimizer, criterion, features, targets, device)
+        if sync_free:
+            meter.update(loss)
+            if index % log_interval == 0:
+                meter.check()
+        else:
+            loss.item()
+    if sync_free:
+        meter.mean()
+    torch.cuda.synchronize(device)
+    return len(batches) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Step rate with and without per-batch host synchronization')
+    parser.add_argument(
+        '--device',
+        default='cuda:0'
+    )
+    parser.add_argument(
+        '--approach',
+        default='cnn10',
+        choices=['cnn10', 'cnn14']
+    )
+    parser.add_argument(
+        '--input-shape',
+        default='1x1001x64',
+        help='Shape of one sample, e.g. 3x64x64 for CIFAR10'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=32
+    )
+    parser.add_argument(
+        '--steps',
+        type=int,
+        default=200
+    )
+    parser.add_argument(
+        '--warmup',
+        type=int,
+        default=20
+    )
+    parser.add_argument(
+        '--log-interval',
+        type=int,
+        default=50
+    )
+    args = parser.parse_args()
+
+    device = args.device
+    shape = tuple(int(x) for x in args.input_shape.split('x'))
+    model_class = Cnn10 if args.approach == 'cnn10' else Cnn14
+    model = model_class(output_dim=10, in_channels=shape[0]).to(device)
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4, momentum=0.9)
+    criterion = torch.nn.CrossEntropyLoss()
+    # batches are created on the device beforehand,
+    # so that only the synchronization differs between the runs
+    batches = [
+        (
+            torch.randn(args.batch_size, *shape, device=device),
+            torch.randint(0, 10, (args.batch_size,), device=device)
+        )
+        for _ in range(args.steps)
+    ]
+
+    run_steps(model, optimizer, criterion, batches[:args.warmup], device, True, args.log_interval)
+    results = {}
+    for name, sync_free in [('per-batch sync', False), ('sync-free', True)]:
+        results[name] = run_steps(
+            model, optimizer, criterion, batches, device, sync_free, args.log_interval)
+        print(f'{name}:\t{results[name]:.2f} steps/s')
+    print(f'speedup:\t{results["sync-free"] / results["per-batch sync"]:.3f}x')
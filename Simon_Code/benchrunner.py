@@ -24,6 +24,12 @@ def bench_setup_grid_1(args):
     if "SAM" in args.optimizer:
         sam_optim = SAMWrapper(SGD, momentum=0.9)
         optimizers.append(sam_optim)
+    if "LookSAM" in args.optimizer:
+        looksam_optim = SAMWrapper(SGD, variant="looksam", momentum=0.9)
+        optimizers.append(looksam_optim)
+    if "ESAM" in args.optimizer:
+        esam_optim = SAMWrapper(SGD, variant="esam", momentum=0.9)
+        optimizers.append(esam_optim)
     #sgd_optim2 = OptimizerWrapper(SGD, momentum=0.9)
     
     print("main")
@@ -68,7 +74,12 @@ def bench_setup_grid_1(args):
         #base_folder=args.data_root,
         base_folder="",
         disable_progress_bar=True,
-        num_gpus=args.num_gpus
+        num_gpus=args.num_gpus,
+        amp=args.amp,
+        micro_batch_size=args.micro_batch_size,
+        fisher=args.fisher,
+        fisher_samples=args.fisher_samples,
+        half_outputs=args.half_outputs
     )
 
     grid1.exclude_permutations([
@@ -475,6 +486,35 @@ if __name__ == '__main__':
         type=int,
         default=0
     )
+    parser.add_argument(
+        '--amp',
+        default=None,
+        choices=['fp16', 'bf16'],
+        help='Train with automatic mixed precision'
+    )
+    parser.add_argument(
+        '--micro-batch-size',
+        default=None,
+        type=int,
+        help='Accumulate gradients over micro-batches of this size, halved on out-of-memory errors'
+    )
+    parser.add_argument(
+        '--fisher',
+        default='sampled',
+        choices=['sampled', 'empirical'],
+        help='Statistics of (E)KFAC from sampled or from training targets'
+    )
+    parser.add_argument(
+        '--fisher-samples',
+        default=1,
+        type=int,
+        help='Targets sampled per input for the statistics of (E)KFAC'
+    )
+    parser.add_argument(
+        '--half-outputs',
+        action='store_true',
+        help='Write the test outputs (outputs.npy) as float16'
+    )
 
     parser.add_argument('--batch_size', nargs='+', type=int, default=[32])
     parser.add_argument('--epochs', nargs='+', type=int, default=[50])
@@ -3,10 +3,10 @@ import models
 from utils import get_output_dim, evaluate_categorical, transfer_features, batches_from_dataloader
 import tqdm
 import pandas as pd
-from datasets import CachedDataset
+from datasets import CachedDataset, collate_batch
+from metadata import load_dcase
 import sharpness_adaptive
 from torchinfo import summary
-import os
 from utils import LabelEncoder
 
 # import argparse
@@ -158,7 +158,8 @@ def calculate_sharpness(model, device, loader, transfer_func, disable, criterion
                 loader,
                 transfer_features,
                 True,
-                criterion
+                criterion,
+                store_outputs=False
             )
     batches = batches_from_dataloader(loader, test=True)
     # sharpness_obj, sharpness_err, _, output = sharpness_adaptive.eval_APGD_sharpness(
@@ -175,29 +176,6 @@ def calculate_sharpness(model, device, loader, transfer_func, disable, criterion
         )
     return sharpness_values
 
-def get_scene_category(x):
-    if x in [
-        'airport',
-        'shopping_mall',
-        'metro_station'
-    ]:
-        return 'indoor'
-    elif x in [
-        'park',
-        'public_square',
-        'street_pedestrian',
-        'street_traffic'
-    ]:
-        return 'outdoor'
-    elif x in [
-        'bus',
-        'metro',
-        'tram'
-    ]:
-        return 'transportation'
-    else:
-        raise NotImplementedError(f'{x} not supported.')
-
 if __name__ == '__main__':
     # Test
     model_path = "/nas/staff/data_work/manuel/cloned_repos/visualisation/results/test/run06/cnn10_None_Adam_0-001_32_100_42_None_None/state.pth.tar"
@@ -209,55 +187,8 @@ if __name__ == '__main__':
 
 
     # load dataset:
-    df_train = pd.read_csv(
-    os.path.join(
-            "/data/eihw-gpu5/milliman/DCASE/DCASE2020/metadata",
-            'evaluation_setup',
-            'fold1_train.csv'
-        ), sep='\t').set_index('filename')
-    df_train['scene_category'] = df_train['scene_label'].apply(
-        get_scene_category)
-    df_train['city'] = [
-        os.path.basename(x).split('-')[1]
-        for x in df_train.index.get_level_values('filename')
-    ]
-    df_train['device'] = [
-        os.path.basename(x).split('-')[-1].split('.')[0]
-        for x in df_train.index.get_level_values('filename')
-    ]
-    
-    df_dev = pd.read_csv(
-        os.path.join(
-            "/data/eihw-gpu5/milliman/DCASE/DCASE2020/metadata",
-            'evaluation_setup',
-            'fold1_evaluate.csv'
-        ), sep='\t').set_index('filename')
-    df_dev['scene_category'] = df_dev['scene_label'].apply(get_scene_category)
-    df_dev['city'] = [
-        os.path.basename(x).split('-')[1]
-        for x in df_dev.index.get_level_values('filename')
-    ]
-    df_dev['device'] = [
-        os.path.basename(x).split('-')[-1].split('.')[0]
-        for x in df_dev.index.get_level_values('filename')
-    ]
-    
-    df_test = pd.read_csv(
-        os.path.join(
-            "/data/eihw-gpu5/milliman/DCASE/DCASE2020/metadata",
-            'evaluation_setup',
-            'fold1_evaluate.csv'
-        ), sep='\t').set_index('filename')
-    df_test['scene_category'] = df_test['scene_label'].apply(
-        get_scene_category)
-    df_test['city'] = [
-        os.path.basename(x).split('-')[1]
-        for x in df_test.index.get_level_values('filename')
-    ]
-    df_test['device'] = [
-        os.path.basename(x).split('-')[-1].split('.')[0]
-        for x in df_test.index.get_level_values('filename')
-    ]
+    df_train, df_dev, df_test = load_dcase(
+        "/data/eihw-gpu5/milliman/DCASE/DCASE2020/metadata")
 
     n_classes = len(df_train['scene_label'].unique())
     encoder = LabelEncoder(
@@ -288,7 +219,8 @@ if __name__ == '__main__':
         train_dataset,
         shuffle=True,
         batch_size=batch_size,
-        num_workers=4
+        num_workers=4,
+        collate_fn=collate_batch
     )
     
     
@@ -313,7 +245,8 @@ if __name__ == '__main__':
                 train_loader,
                 transfer_features,
                 True,
-                criterion
+                criterion,
+                store_outputs=False
             )
     batches = batches_from_dataloader(train_loader, test=True)
     sharpness_obj, sharpness_err, _, output = sharpness_adaptive.eval_APGD_sharpness(
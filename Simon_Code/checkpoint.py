@@ -0,0 +1,204 @@
+import numpy as np
+import os
+import queue
+import random
+import threading
+import torch
+
+
+class CheckpointWriter(object):
+    r"""Background thread writing checkpoints and other epoch outputs.
+
+    States are copied into (pinned) host buffers without blocking,
+    the thread waits for the copies and writes them to disk
+    while the next epoch trains.
+    Only the states selected by the retention policy are kept on disk.
+
+    Args:
+        max_pending: jobs waiting in the queue,
+            adding more blocks until a job is done
+        keep_last: number of most recent epoch states to keep,
+            ``None`` keeps all
+        keep_best: keep the state of the best epoch
+        keep_every: additionally keep the state of every N-th epoch
+        pin_memory: copy CUDA tensors into pinned host memory
+    """
+
+    def __init__(
+        self,
+        max_pending: int = 4,
+        keep_last: int = None,
+        keep_best: bool = True,
+        keep_every: int = None,
+        pin_memory: bool = True
+    ):
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.keep_every = keep_every
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.states = {}
+        self.best_epoch = None
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            func, args, kwargs = job
+            try:
+                if self.error is None:
+                    func(*args, **kwargs)
+            except BaseException as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def snapshot(self, state_dict):
+        r"""Host copy of ``state_dict``, CUDA tensors are copied asynchronously.
+
+        Nested dicts, lists and tuples (e.g. optimizer states) are copied as well.
+        Returns the copy and an event marking the end of the copies
+        (``None`` if nothing was copied from a GPU).
+        """
+        cuda = []
+        snapshot = self._copy(state_dict, cuda)
+        event = None
+        if cuda:
+            event = torch.cuda.Event()
+            event.record()
+        return snapshot, event
+
+    def _copy(self, value, cuda):
+        if torch.is_tensor(value):
+            copy = torch.empty(
+                value.shape,
+                dtype=value.dtype,
+                pin_memory=self.pin_memory and value.is_cuda
+            )
+            copy.copy_(value.detach(), non_blocking=value.is_cuda)
+            if value.is_cuda:
+                cuda.append(value.device)
+            return copy
+        if isinstance(value, dict):
+            return {key: self._copy(item, cuda) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._copy(item, cuda) for item in value)
+        return value
+
+    def submit(self, func, *args, **kwargs):
+        r"""Run ``func(*args, **kwargs)`` in the writer thread."""
+        self._raise()
+        self.queue.put((func, args, kwargs))
+
+    def save_state(self, state_dict, path, epoch, is_best=False, retain=True):
+        r"""Save a snapshot of ``state_dict`` to ``path`` in the background.
+
+        Returns the snapshot, which is safe to keep
+        (e.g. as best state) once :meth:`close` returned.
+
+        Args:
+            state_dict: state to save
+            path: file to save the state in
+            epoch: epoch of the state, used by the retention policy
+            is_best: state of the best epoch so far
+            retain: apply the retention policy afterwards,
+                otherwise it is deferred to the next :meth:`retain`
+                (e.g. until a resume file no longer refers to old states)
+        """
+        snapshot, event = self.snapshot(state_dict)
+        self.submit(self._save, snapshot, event, path, epoch, is_best, retain)
+        return snapshot
+
+    def retain(self):
+        r"""Apply the retention policy after all jobs submitted so far."""
+        self.submit(self._apply_retention)
+
+    def write(self, state, path):
+        r"""Save a snapshot of ``state`` to ``path`` in the background.
+
+        Unlike :meth:`save_state` the file is not subject to the retention policy,
+        it is replaced atomically.
+        """
+        snapshot, event = self.snapshot(state)
+        self.submit(self._write, snapshot, event, path)
+
+    def track(self, path, epoch, is_best=False):
+        r"""Add an existing state file to the retention policy, e.g. after resuming."""
+        self.states[epoch] = path
+        if is_best:
+            self.best_epoch = epoch
+
+    def _write(self, snapshot, event, path):
+        if event is not None:
+            event.synchronize()
+        tmp = path + '.tmp'
+        torch.save(snapshot, tmp)
+        os.replace(tmp, path)
+
+    def _save(self, snapshot, event, path, epoch, is_best, retain=True):
+        self._write(snapshot, event, path)
+        self.states[epoch] = path
+        if is_best:
+            self.best_epoch = epoch
+        if retain:
+            self._apply_retention()
+
+    def _apply_retention(self):
+        epochs = sorted(self.states)
+        keep = set(epochs if self.keep_last is None else epochs[-self.keep_last:])
+        if self.keep_best and self.best_epoch is not None:
+            keep.add(self.best_epoch)
+        if self.keep_every is not None:
+            keep.update(e for e in epochs if e % self.keep_every == 0)
+        for epoch in epochs:
+            if epoch not in keep:
+                path = self.states.pop(epoch)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def wait(self):
+        r"""Block until all submitted jobs are done."""
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def rng_state(generator=None):
+    r"""State of all random number generators (and ``generator``)."""
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        'numpy': np.random.get_state(),
+        'random': random.getstate(),
+        'generator': generator.get_state() if generator is not None else None
+    }
+
+
+def set_rng_state(state, generator=None):
+    r"""Restore a state returned by :func:`rng_state`."""
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if generator is not None and state['generator'] is not None:
+        generator.set_state(state['generator'])
@@ -1,117 +1,368 @@
 import audiofile
 import numpy as np
+import os
 import pandas as pd
 import torch
-from os.path import basename
+import tqdm
+from torch.utils.data.dataloader import default_collate
+from feature_store import (
+    AUDIO_SCALE,
+    PackedFeatures,
+    resolve_feature_path
+)
+
+
+def encode_targets(df, target_column, target_transform=None):
+    r"""Targets of all rows with ``target_transform`` already applied.
+
+    Integer targets (e.g. from :class:`utils.LabelEncoder`)
+    are returned as a contiguous int64 array.
+    """
+    if isinstance(target_column, list) and len(target_column) > 1:
+        targets = list(df[target_column].to_numpy())
+    else:
+        targets = df[target_column].to_numpy()
+    if target_transform is not None:
+        targets = [target_transform(target) for target in targets]
+    targets = np.asarray(targets)
+    if np.issubdtype(targets.dtype, np.integer):
+        targets = np.ascontiguousarray(targets, dtype=np.int64)
+    return targets
+
+
+def encode_strata(df, stratify):
+    r"""Integer codes and labels of every stratification column in ``df``."""
+    strata = {}
+    strata_labels = {}
+    for column in stratify or []:
+        codes, labels = pd.factorize(df[column])
+        strata[column] = codes.astype(np.int64)
+        strata_labels[column] = np.asarray(labels)
+    return strata, strata_labels
+
+
+def collate_batch(batch):
+    r"""Collate function accepting batches assembled by ``__getitems__``.
+
+    Must be used for DataLoaders over :class:`CachedDataset`.
+    """
+    if isinstance(batch, tuple):
+        return batch
+    return default_collate(batch)
+
+
+def collate_crops(batch):
+    r"""Collate samples holding several crops into one flat batch.
+
+    Every crop becomes a batch entry with the target of its clip,
+    see ``crops_per_clip`` of :class:`WavDataset`.
+    """
+    signals, targets = default_collate(batch)
+    crops = signals.shape[1]
+    return signals.flatten(0, 1), targets.repeat_interleave(crops)
+
+
+class WindowBatch(object):
+    r"""Batch of whole clips of different length.
+
+    Clips are concatenated into one signal,
+    the model cuts them into sliding windows
+    on the device (see ``Model.forward`` in ``training.py``).
+
+    Args:
+        signals: samples of all clips, concatenated
+        lengths: number of samples of every clip
+    """
+
+    def __init__(self, signals, lengths):
+        self.signals = signals
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def to(self, device):
+        return WindowBatch(self.signals.to(device), self.lengths)
+
+    def float(self):
+        return WindowBatch(self.signals.float(), self.lengths)
+
+
+def collate_windows(batch):
+    r"""Collate mono clips of any length into a :class:`WindowBatch`."""
+    signals, targets = zip(*batch)
+    signals = [torch.as_tensor(signal).flatten() for signal in signals]
+    lengths = torch.tensor([len(signal) for signal in signals])
+    return WindowBatch(torch.cat(signals), lengths), torch.as_tensor(np.asarray(targets))
 
 
 class CachedDataset(torch.utils.data.Dataset):
     r"""Dataset of cached features.
 
+    Targets, feature locations and stratification columns
+    are converted to arrays on construction,
+    so the partition dataframe is not kept (and not sent to workers).
+
     Args:
         df: partition dataframe containing labels
         features: dataframe with paths to features
+            or :class:`feature_store.PackedFeatures`
         target_column: column to find labels in (in df)
         transform: function used to process features
         target_transform: function used to process labels
+        feature_dir: optional folder overriding the feature location
+            (ignored for packed features)
+        stratify: columns (in df) to keep as integer codes in ``strata``
     """
 
     def __init__(
-        self, 
+        self,
         df: pd.DataFrame,
-        features: pd.DataFrame,
-        target_column: str, 
-        transform=None, 
+        features,
+        target_column: str,
+        transform=None,
         target_transform=None,
-        feature_dir=""
+        feature_dir="",
+        stratify=None
     ):
-        self.df = df
-        self.features = features
         self.target_column = target_column
         self.transform = transform
         self.target_transform = target_transform
-        self.indices = list(self.df.index)
+        self.indices = df.index.to_numpy()
         self.feature_dir = feature_dir
+        self.targets = encode_targets(df, target_column, target_transform)
+        self.strata, self.strata_labels = encode_strata(df, stratify)
+        if isinstance(features, PackedFeatures):
+            self.features = features
+            self.rows = features.rows(self.indices)
+            self.paths = None
+        else:
+            self.features = None
+            self.rows = None
+            self.paths = np.array([
+                resolve_feature_path(path, feature_dir)
+                for path in features.loc[self.indices, 'features']
+            ])
 
     def __len__(self):
-        return len(self.df)
-
-    # def __getitem__(self, item):
-    #     index = self.indices[item]
-    #     signal = np.load(self.features.loc[index, 'features'] + '.npy')
-    #     target = self.df[self.target_column].loc[index]
-    #     if isinstance(self.target_column, list) and len(self.target_column) > 1:
-    #         target = np.array(target.values)
-
-    #     if self.transform is not None:
-    #         signal = self.transform(signal)
-
-    #     if self.target_transform is not None:
-    #         target = self.target_transform(target)
-
-    #     return signal, target
+        return len(self.indices)
 
     def __getitem__(self, item):
-        index = self.indices[item]
-        if self.feature_dir == "":
-            signal = np.load(self.features.loc[index, 'features'] + '.npy')
+        if self.rows is not None:
+            signal = self.features[self.rows[item]]
         else:
-            signal = np.load(self.feature_dir + basename(self.features.loc[index, 'features'] + '.npy'))
-        target = self.df[self.target_column].loc[index]
-        if isinstance(self.target_column, list) and len(self.target_column) > 1:
-            target = np.array(target.values)
+            signal = np.load(self.paths[item])
+        target = self.targets[item]
 
         if self.transform is not None:
-            # print(signal.shape)
             signal = self.transform(signal)
-            # print(signal.shape)
-
-        if self.target_transform is not None:
-            target = self.target_transform(target)
 
         return signal, target
 
+    def __getitems__(self, items):
+        r"""Fetch a whole batch as ``(features, targets)`` tensors.
+
+        Features are gathered into a single array
+        without per-sample tensor conversion,
+        see :func:`collate_batch`.
+        """
+        if self.transform is not None:
+            return [self[item] for item in items]
+        items = np.asarray(items, dtype=np.int64)
+        if self.rows is not None:
+            signals = self.features.gather(self.rows[items])
+        else:
+            signals = np.stack([np.load(path) for path in self.paths[items]])
+        return torch.from_numpy(signals), torch.as_tensor(self.targets[items])
+
 
 class WavDataset(torch.utils.data.Dataset):
     r"""Dataset of raw audio data.
 
+    Audio is either decoded from the files in the index of ``df``
+    or sliced from an int16 store (see :func:`feature_store.pack_audio`),
+    in which case the index holds the filenames of the store.
+    With ``crop_length`` only random crops of every clip are returned,
+    crops from the store are read directly without touching the rest of the clip.
+
     Args:
         df: partition dataframe containing labels
-        features: dataframe with paths to features
+        features: dataframe with paths to features (unused)
         target_column: column to find labels in (in df)
         transform: function used to process features
         target_transform: function used to process labels
+        feature_dir: unused, accepted for compatibility with :class:`CachedDataset`
+        stratify: columns (in df) to keep as integer codes in ``strata``
+        audio: optional :class:`feature_store.PackedFeatures` of int16 audio
+        crop_length: length of random crops in samples,
+            ``None`` returns whole clips
+        crops_per_clip: number of crops drawn per fetch,
+            returned as an additional first dimension if larger than one
+            (use :func:`collate_crops`)
     """
 
     def __init__(
-        self, 
+        self,
         df: pd.DataFrame,
         features: pd.DataFrame,
-        target_column: str, 
-        transform=None, 
+        target_column: str,
+        transform=None,
         target_transform=None,
+        feature_dir="",
+        stratify=None,
+        audio: PackedFeatures = None,
+        crop_length: int = None,
+        crops_per_clip: int = 1
     ):
-        self.df = df
-        self.features = features
         self.target_column = target_column
         self.transform = transform
         self.target_transform = target_transform
-        self.indices = list(self.df.index)
+        self.indices = df.index.to_numpy()
+        self.paths = self.indices
+        self.targets = encode_targets(df, target_column, target_transform)
+        self.strata, self.strata_labels = encode_strata(df, stratify)
+        self.audio = audio
+        self.rows = audio.rows(self.indices) if audio is not None else None
+        self.crop_length = crop_length
+        self.crops_per_clip = crops_per_clip
 
     def __len__(self):
-        return len(self.df)
+        return len(self.indices)
+
+    def load(self, item):
+        if self.rows is not None:
+            # memory-mapped view, only read when sliced
+            return self.audio[self.rows[item]]
+        return audiofile.read(self.paths[item], always_2d=False)[0]
+
+    def crop(self, signal):
+        length = signal.shape[-1]
+        starts = torch.randint(
+            0,
+            max(length - self.crop_length, 0) + 1,
+            (self.crops_per_clip,)
+        ).tolist()
+        crops = np.stack([
+            signal[..., start:start + self.crop_length] for start in starts
+        ])
+        if self.crops_per_clip == 1:
+            crops = crops[0]
+        return crops
 
     def __getitem__(self, item):
-        index = self.indices[item]
-        signal = audiofile.read(index, always_2d=False)[0]
-        target = self.df[self.target_column].loc[index]
-        if isinstance(self.target_column, list) and len(self.target_column) > 1:
-            target = np.array(target.values)
+        signal = self.load(item)
+        if self.crop_length is not None:
+            signal = self.crop(signal)
+        if signal.dtype == np.int16:
+            signal = signal.astype(np.float32) / AUDIO_SCALE
+        target = self.targets[item]
 
         if self.transform is not None:
             signal = self.transform(signal)
 
-        if self.target_transform is not None:
-            target = self.target_transform(target)
+        return signal, target
+
+
+class TensorImageDataset(torch.utils.data.Dataset):
+    r"""Dataset of preprocessed images held in one tensor.
+
+    Args:
+        images: tensor of all images
+        targets: tensor of all targets
+        class_to_idx: mapping of class names to targets
+    """
+
+    def __init__(self, images, targets, class_to_idx=None):
+        self.images = images
+        self.targets = targets
+        self.class_to_idx = class_to_idx
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, item):
+        return self.images[item], self.targets[item]
+
+    def __getitems__(self, items):
+        items = torch.as_tensor(items, dtype=torch.int64)
+        return self.images[items], self.targets[items]
+
+
+def cache_images(dataset, path, dtype=torch.float16, batch_size=500, num_workers=4):
+    r"""Apply the (deterministic) transform of an image dataset once.
+
+    The transformed images of ``dataset`` are stored in ``path``
+    and loaded from there if it already exists.
+
+    Args:
+        dataset: torchvision image dataset including its transform
+        path: file to store the tensors in
+        dtype: data type images are stored with
+        batch_size: images transformed at once
+        num_workers: processes used for the transform
+    """
+    if not os.path.exists(path):
+        loader = torch.utils.data.DataLoader(
+            dataset,
+            shuffle=False,
+            batch_size=batch_size,
+            num_workers=num_workers
+        )
+        images = []
+        targets = []
+        for image, target in tqdm.tqdm(loader, desc='Caching images'):
+            images.append(image.to(dtype))
+            targets.append(target)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # written under a temporary name so that parallel runs never read a partial file
+        tmp = '{}.tmp{}'.format(path, os.getpid())
+        torch.save({
+            'images': torch.cat(images),
+            'targets': torch.cat(targets),
+            'class_to_idx': dataset.class_to_idx
+        }, tmp)
+        os.replace(tmp, path)
+    cache = torch.load(path)
+    return TensorImageDataset(
+        cache['images'], cache['targets'], cache['class_to_idx'])
+
+
+class DeviceLoader(object):
+    r"""Index-based batching of a :class:`TensorImageDataset` on the device.
 
-        return signal, target
\ No newline at end of file
+    Replacement for :class:`torch.utils.data.DataLoader`
+    without worker processes,
+    all images are copied to ``device`` once
+    and batches are gathered there.
+
+    Args:
+        dataset: :class:`TensorImageDataset` or a subset of it
+        batch_size: number of samples per batch
+        shuffle: draw a new order of the samples every epoch
+        device: device to keep the images on
+        generator: generator used for shuffling
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=False, device='cpu', generator=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = generator
+        if isinstance(dataset, torch.utils.data.Subset):
+            indices = torch.as_tensor(dataset.indices, dtype=torch.int64)
+            dataset = dataset.dataset
+        else:
+            indices = torch.arange(len(dataset))
+        self.images = dataset.images[indices].to(device)
+        self.targets = dataset.targets[indices].to(device)
+
+    def __len__(self):
+        return (len(self.targets) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.targets), generator=self.generator)
+        else:
+            order = torch.arange(len(self.targets))
+        for batch in order.to(self.images.device).split(self.batch_size):
+            yield self.images[batch], self.targets[batch]
@@ -0,0 +1,456 @@
+import argparse
+import audiofile
+import fcntl
+import hashlib
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import tqdm
+import yaml
+
+
+STORE_FILE = 'store.yaml'
+INDEX_FILE = 'index.csv'
+DATA_FILE = 'features.bin'
+# shared lock held by every run using a cache entry, see `evict_features`
+USE_FILE = '.in_use'
+CACHE_ROOT = '/dev/shm/sharpnessasc'
+# int16 audio is stored as round(signal * AUDIO_SCALE)
+AUDIO_SCALE = 32768
+
+
+def resolve_feature_path(path, feature_dir=''):
+    r"""Path of a per-clip ``.npy`` feature file as listed in ``features.csv``."""
+    if feature_dir == '':
+        return path + '.npy'
+    return feature_dir + os.path.basename(path + '.npy')
+
+
+def is_packed_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, STORE_FILE))
+
+
+def load_features(path):
+    r"""Load features either from a packed store or a ``features.csv``.
+
+    Args:
+        path: folder of a packed store or path to ``features.csv``
+            (old layout with one ``.npy`` file per clip)
+    """
+    if is_packed_store(path):
+        return PackedFeatures(path)
+    return pd.read_csv(path).set_index('filename')
+
+
+class PackedFeatures:
+    r"""Features of all clips packed into one memory-mapped file.
+
+    Entries are stored back-to-back in ``features.bin``,
+    ``index.csv`` holds the offset (in elements) and shape of every entry.
+    The memory map is opened lazily so that the object can be
+    sent to DataLoader workers without copying the data.
+
+    Args:
+        root: folder containing the packed store
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, STORE_FILE), 'r') as fp:
+            meta = yaml.safe_load(fp)
+        self.dtype = np.dtype(meta['dtype'])
+        index = pd.read_csv(os.path.join(root, INDEX_FILE))
+        self.filenames = index['filename'].to_numpy()
+        self.offsets = index['offset'].to_numpy(dtype=np.int64)
+        self.shapes = [
+            tuple(int(x) for x in shape.split('x'))
+            for shape in index['shape']
+        ]
+        self.sizes = np.array(
+            [int(np.prod(shape)) for shape in self.shapes], dtype=np.int64)
+        self.lookup = pd.Series(
+            np.arange(len(index), dtype=np.int64), index=index['filename'])
+        unique_shapes = set(self.shapes)
+        self.shape = unique_shapes.pop() if len(unique_shapes) == 1 else None
+        # equally shaped entries stored back-to-back can be viewed as one array
+        self.stacked = self.shape is not None and np.array_equal(
+            self.offsets, np.arange(len(index), dtype=np.int64) * int(np.prod(self.shape)))
+        self._data = None
+        self._use = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(
+                os.path.join(self.root, DATA_FILE),
+                dtype=self.dtype,
+                mode='r'
+            )
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        state['_use'] = None
+        return state
+
+    def pin(self):
+        r"""Mark the store as in use until :meth:`close` (or deletion of this object).
+
+        Entries of the shared cache in use by any process
+        are never evicted (see :func:`evict_features`),
+        so that DataLoader workers can reopen them every epoch.
+        Copies sent to workers do not hold the lock.
+        """
+        if self._use is None:
+            self._use = open(os.path.join(self.root, USE_FILE), 'a')
+            fcntl.flock(self._use, fcntl.LOCK_SH)
+
+    def close(self):
+        self._data = None
+        if self._use is not None:
+            self._use.close()
+            self._use = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def rows(self, filenames):
+        r"""Row of every filename in the store."""
+        return self.lookup.loc[list(filenames)].to_numpy(dtype=np.int64)
+
+    def __getitem__(self, row):
+        offset = self.offsets[row]
+        return self.data[offset:offset + self.sizes[row]].reshape(
+            self.shapes[row])
+
+    def gather(self, rows):
+        r"""Stack the entries of ``rows`` into one array.
+
+        Entries of a stacked store are read in one vectorized gather,
+        in file order to keep reads sequential.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if not self.stacked:
+            return np.stack([self[row] for row in rows])
+        data = self.data[:len(self) * self.sizes[0]].reshape(len(self), *self.shape)
+        order = np.argsort(rows, kind='stable')
+        batch = np.empty((len(rows),) + self.shape, dtype=self.dtype)
+        batch[order] = data[rows[order]]
+        return batch
+
+
+class PackedFeatureWriter:
+    r"""Streaming writer for :class:`PackedFeatures`.
+
+    The store only becomes readable once the writer is closed.
+    Calling :meth:`flush` persists the index written so far,
+    which allows an interrupted extraction to continue
+    with ``resume=True``.
+
+    Args:
+        root: folder to create the packed store in
+        dtype: data type features are stored with
+        resume: continue a store that has been flushed before
+    """
+
+    def __init__(self, root: str, dtype: str = 'float32', resume: bool = False):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.dtype = np.dtype(dtype)
+        self.entries = []
+        self.offset = 0
+        data_file = os.path.join(root, DATA_FILE)
+        index_file = os.path.join(root, INDEX_FILE)
+        if resume and os.path.exists(data_file) and os.path.exists(index_file):
+            index = pd.read_csv(index_file)
+            self.entries = list(index.itertuples(index=False, name=None))
+            if len(self.entries) > 0:
+                _, offset, shape = self.entries[-1]
+                self.offset = offset + int(np.prod([int(x) for x in shape.split('x')]))
+            self.fp = open(data_file, 'r+b')
+            # drop data written after the last flush
+            self.fp.truncate(self.offset * self.dtype.itemsize)
+            self.fp.seek(0, os.SEEK_END)
+        else:
+            self.fp = open(data_file, 'wb')
+
+    @property
+    def filenames(self):
+        return set(entry[0] for entry in self.entries)
+
+    def append(self, filename, array):
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        self.fp.write(array.tobytes())
+        self.entries.append(
+            (filename, self.offset, 'x'.join(str(x) for x in array.shape)))
+        self.offset += array.size
+
+    def flush(self):
+        self.fp.flush()
+        pd.DataFrame(
+            data=self.entries,
+            columns=['filename', 'offset', 'shape']
+        ).to_csv(os.path.join(self.root, INDEX_FILE), index=False)
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+        with open(os.path.join(self.root, STORE_FILE), 'w') as fp:
+            yaml.dump({'dtype': self.dtype.name, 'entries': len(self.entries)}, fp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def pack_features(features: pd.DataFrame, dest: str, dtype: str = 'float32', feature_dir: str = ''):
+    r"""Pack the per-clip ``.npy`` files listed in ``features`` into a store.
+
+    Args:
+        features: dataframe with paths to features (indexed by filename)
+        dest: folder to create the packed store in
+        dtype: data type features are stored with
+        feature_dir: optional folder overriding the feature location
+    """
+    with PackedFeatureWriter(dest, dtype) as writer:
+        for filename, path in tqdm.tqdm(
+            features['features'].items(),
+            total=len(features),
+            desc='Packing'
+        ):
+            writer.append(filename, np.load(resolve_feature_path(path, feature_dir)))
+    return PackedFeatures(dest)
+
+
+def pack_audio(root: str, dest: str, filenames=None):
+    r"""Decode audio files into an int16 store.
+
+    Entries are indexed by their filename relative to ``root``
+    (as listed in the DCASE ``meta.csv`` and partition files).
+    The store is packed in ``<dest>.tmp`` and renamed once complete,
+    a file lock (``<dest>.lock``) makes sure that
+    concurrent runs pack it only once.
+    Already packed files are skipped,
+    so an interrupted run can be restarted.
+
+    Args:
+        root: path to unzipped DCASE-Task1 data
+        dest: folder to create the packed store in
+        filenames: files to pack, defaults to all files in ``meta.csv``
+    """
+    dest = os.path.normpath(dest)
+    tmp = dest + '.tmp'
+    with open(dest + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # packed by another run while waiting for the lock
+        if not is_packed_store(dest):
+            if os.path.isdir(dest):
+                # interrupted store packed in place by an older version
+                if os.path.exists(tmp):
+                    shutil.rmtree(dest)
+                else:
+                    os.rename(dest, tmp)
+            if filenames is None:
+                filenames = pd.read_csv(
+                    os.path.join(root, 'meta.csv'), sep='\t')['filename']
+            writer = PackedFeatureWriter(tmp, 'int16', resume=True)
+            done = writer.filenames
+            todo = [f for f in filenames if f not in done]
+            for counter, filename in enumerate(tqdm.tqdm(todo, desc='Packing audio')):
+                signal = audiofile.read(os.path.join(root, filename), always_2d=False)[0]
+                writer.append(filename, np.clip(
+                    np.round(signal * AUDIO_SCALE), -AUDIO_SCALE, AUDIO_SCALE - 1))
+                if counter % 500 == 0:
+                    writer.flush()
+            writer.close()
+            os.rename(tmp, dest)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return PackedFeatures(dest)
+
+
+def load_audio(path: str, root: str):
+    r"""Open the int16 audio store in ``path``, pack it first if missing."""
+    if is_packed_store(path):
+        return PackedFeatures(path)
+    return pack_audio(root, path)
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _folder_size(folder):
+    return sum(
+        os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+
+
+def feature_cache_key(path, *extra):
+    r"""Cache key of a feature set.
+
+    Hash of ``features.csv`` (or of the index of a packed store)
+    combined with everything else changing the cached data.
+    """
+    source = os.path.join(path, INDEX_FILE) if is_packed_store(path) else path
+    digest = hashlib.sha1(_file_digest(source).encode())
+    for value in extra:
+        digest.update(repr(value).encode())
+    return digest.hexdigest()[:16]
+
+
+def evict_features(cache_root, needed=0, capacity=None, keep=None):
+    r"""Remove least recently used entries until ``needed`` bytes fit.
+
+    Entries in use by a run (see :meth:`PackedFeatures.pin`) are skipped,
+    an entry is removed while holding its lock exclusively.
+
+    Args:
+        cache_root: folder of the cache
+        needed: bytes about to be added to the cache
+        capacity: size of the cache in bytes, ``None`` for unlimited
+        keep: entry which must not be evicted
+    """
+    if capacity is None:
+        return
+    entries = []
+    for entry in os.listdir(cache_root):
+        folder = os.path.join(cache_root, entry)
+        if entry == keep or not is_packed_store(folder):
+            continue
+        # last use is recorded on the store file, see `cache_features`
+        entries.append((
+            os.path.getmtime(os.path.join(folder, STORE_FILE)),
+            _folder_size(folder),
+            folder
+        ))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    while entries and total + needed > capacity:
+        _, size, folder = entries.pop(0)
+        with open(os.path.join(folder, USE_FILE), 'a') as use:
+            try:
+                fcntl.flock(use, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            shutil.rmtree(folder, ignore_errors=True)
+        total -= size
+
+
+def cache_features(
+    path: str,
+    features,
+    cache_root: str = CACHE_ROOT,
+    capacity: float = None,
+    dtype: str = 'float32',
+    feature_dir: str = '',
+    custom_feature_path: str = None
+):
+    r"""Packed copy of a feature set in shared memory.
+
+    The first caller on a node packs the features into
+    ``cache_root`` (``/dev/shm`` by default),
+    every later call (other runs, other processes)
+    maps the same files instead of reading the features again.
+    Entries are keyed by :func:`feature_cache_key`,
+    a file lock makes sure that each entry is only built once.
+    The returned store is pinned (see :meth:`PackedFeatures.pin`),
+    it is not evicted by other runs while it is alive.
+
+    Args:
+        path: path to ``features.csv`` or to a packed store
+        features: features loaded from ``path`` by :func:`load_features`
+            (after applying a custom feature path)
+        cache_root: folder of the cache
+        capacity: size of the cache in GB,
+            least recently used entries are evicted when it is exceeded.
+            ``None`` for unlimited
+        dtype: data type features are cached with
+            (ignored if ``features`` are already packed)
+        feature_dir: optional folder overriding the feature location
+        custom_feature_path: custom ``.npy`` location of features
+    """
+    os.makedirs(cache_root, exist_ok=True)
+    if isinstance(features, PackedFeatures):
+        dtype = features.dtype.name
+    key = feature_cache_key(path, dtype, feature_dir, custom_feature_path)
+    entry = os.path.join(cache_root, key)
+    if capacity is not None:
+        capacity = int(capacity * 1024 ** 3)
+
+    with open(os.path.join(cache_root, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not is_packed_store(entry):
+            # leftovers of interrupted builds
+            for name in os.listdir(cache_root):
+                if '.tmp' in name:
+                    shutil.rmtree(os.path.join(cache_root, name), ignore_errors=True)
+            if isinstance(features, PackedFeatures):
+                needed = os.path.getsize(os.path.join(features.root, DATA_FILE))
+            else:
+                needed = sum(
+                    os.path.getsize(resolve_feature_path(f, feature_dir))
+                    for f in features['features']
+                )
+            evict_features(cache_root, needed, capacity, keep=key)
+            tmp = entry + '.tmp{}'.format(os.getpid())
+            if isinstance(features, PackedFeatures):
+                os.makedirs(tmp)
+                for name in [DATA_FILE, INDEX_FILE, STORE_FILE]:
+                    shutil.copyfile(
+                        os.path.join(features.root, name),
+                        os.path.join(tmp, name)
+                    )
+            else:
+                pack_features(features, tmp, dtype, feature_dir)
+            os.rename(tmp, entry)
+        os.utime(os.path.join(entry, STORE_FILE))
+        # pinned before other runs may evict again
+        cached = PackedFeatures(entry)
+        cached.pin()
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return cached
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Pack per-clip features into a memory-mapped store')
+    parser.add_argument(
+        'features',
+        help='Path to features.csv created by melspects.py '
+             '(path to unzipped DCASE-Task1 data with --audio)'
+    )
+    parser.add_argument(
+        'dest',
+        help='Folder to store the packed features in'
+    )
+    parser.add_argument(
+        '--dtype',
+        default='float32',
+        choices=['float16', 'float32']
+    )
+    parser.add_argument(
+        '--feature_dir',
+        default='',
+        help='Custom .npy location of features'
+    )
+    parser.add_argument(
+        '--audio',
+        action='store_true',
+        help='Pack the decoded audio of all clips as int16 instead of features'
+    )
+    args = parser.parse_args()
+    if args.audio:
+        pack_audio(args.features, args.dest)
+    else:
+        pack_features(
+            pd.read_csv(args.features).set_index('filename'),
+            args.dest,
+            args.dtype,
+            args.feature_dir
+        )
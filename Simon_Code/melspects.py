@@ -1,6 +1,7 @@
 import argparse
 import audiofile as af
 import glob
+import multiprocessing
 import numpy as np
 import os
 import pandas as pd
@@ -8,6 +9,101 @@ import torch
 import tqdm
 import torchaudio
 import torchlibrosa
+from feature_store import PackedFeatureWriter
+
+
+SAMPLING_RATE = 16000
+
+# per-process state, created once by `init_worker`
+spectrogram = None
+mel = None
+resamplers = {}
+
+
+def init_worker():
+    global spectrogram, mel
+    # every worker computes its own batches, avoid oversubscribing the CPU
+    torch.set_num_threads(1)
+    ref = 1.0
+    amin = 1e-10
+    top_db = None
+
+    spectrogram = torchlibrosa.stft.Spectrogram(
+        n_fft=512,
+        win_length=512,
+        hop_length=160
+    )
+    mel = torchlibrosa.stft.LogmelFilterBank(
+        sr=SAMPLING_RATE,
+        fmin=50,
+        fmax=8000,
+        n_mels=64,
+        n_fft=512,
+        ref=ref,
+        amin=amin,
+        top_db=top_db
+    )
+
+
+def transform(x):
+    return mel(spectrogram(x)).squeeze(1)
+
+
+def get_resampler(fs):
+    if fs not in resamplers:
+        resamplers[fs] = torchaudio.transforms.Resample(fs, SAMPLING_RATE)
+    return resamplers[fs]
+
+
+def load(path):
+    audio, fs = af.read(path, always_2d=True)
+    audio = torch.from_numpy(audio)
+    if fs != SAMPLING_RATE:
+        audio = get_resampler(fs)(audio)
+    return audio
+
+
+@torch.no_grad()
+def extract(paths):
+    r"""Log-mel spectrograms of a chunk of files.
+
+    Clips of equal length are stacked and
+    passed through the STFT as one batch.
+    """
+    audios = [load(path) for path in paths]
+    logmels = [None] * len(audios)
+    groups = {}
+    for index, audio in enumerate(audios):
+        groups.setdefault(tuple(audio.shape), []).append(index)
+    for shape, indices in groups.items():
+        batch = torch.stack([audios[index] for index in indices])
+        # channels are treated as batch entries like in the single-clip case
+        logmel = transform(batch.view(-1, shape[-1]))
+        logmel = logmel.view(len(indices), shape[0], *logmel.shape[1:])
+        for index, output in zip(indices, logmel):
+            logmels[index] = output.numpy()
+    return logmels
+
+
+def extract_and_save(job):
+    paths, outputs = job
+    for logmel, output in zip(extract(paths), outputs):
+        np.save(output, logmel)
+    return len(paths)
+
+
+def run_jobs(func, jobs, num_workers):
+    r"""Yield results of ``func`` over ``jobs`` in order."""
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers, initializer=init_worker) as pool:
+            yield from pool.imap(func, jobs)
+    else:
+        init_worker()
+        yield from map(func, jobs)
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
 
 if __name__ == '__main__':
@@ -20,49 +116,71 @@ if __name__ == '__main__':
         'dest',
         help='Path to store features in'
     )
+    parser.add_argument(
+        '--num-workers',
+        type=int,
+        default=1,
+        help='Number of extraction processes'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=16,
+        help='Number of clips processed together by one worker'
+    )
+    parser.add_argument(
+        '--packed',
+        action='store_true',
+        help='Write features into a packed store in dest instead of one .npy file per clip'
+    )
+    parser.add_argument(
+        '--dtype',
+        default='float32',
+        choices=['float16', 'float32'],
+        help='Data type of the packed store'
+    )
     args = parser.parse_args()
 
     os.makedirs(args.dest, exist_ok=True)
-    ref = 1.0
-    amin = 1e-10
-    top_db = None
-
-    spectrogram = torchlibrosa.stft.Spectrogram(
-        n_fft=512, 
-        win_length=512, 
-        hop_length=160
-    )
-    mel = torchlibrosa.stft.LogmelFilterBank(
-        sr=16000, 
-        fmin=50, 
-        fmax=8000, 
-        n_mels=64, 
-        n_fft=512, 
-        ref=ref, 
-        amin=amin, 
-        top_db=top_db
-    )
-    transform = lambda x: mel(spectrogram(x)).squeeze(1)
-    
-    filenames = []
     df = pd.read_csv(os.path.join(args.root, 'meta.csv'), sep='\t')
-    for counter, row in tqdm.tqdm(enumerate(df.iterrows()), total=len(df), desc='Melspects'):
-        audio, fs = af.read(
-            os.path.join(args.root, row[1]['filename']),
-            always_2d=True
+
+    if args.packed:
+        # already packed files are skipped, so an interrupted run can be restarted
+        writer = PackedFeatureWriter(args.dest, args.dtype, resume=True)
+        done = writer.filenames
+        todo = [f for f in df['filename'] if f not in done]
+        jobs = chunks(todo, args.batch_size)
+        with tqdm.tqdm(total=len(df), initial=len(df) - len(todo), desc='Melspects') as pbar:
+            for counter, (filenames, logmels) in enumerate(zip(jobs, run_jobs(
+                extract,
+                [[os.path.join(args.root, f) for f in job] for job in jobs],
+                args.num_workers
+            ))):
+                for filename, logmel in zip(filenames, logmels):
+                    writer.append(filename, logmel)
+                if counter % 50 == 0:
+                    writer.flush()
+                pbar.update(len(filenames))
+        writer.close()
+    else:
+        filenames = [
+            os.path.join(args.dest, '{:012}'.format(counter))
+            for counter in range(len(df))
+        ]
+        # skip outputs that already exist
+        todo = [
+            (os.path.join(args.root, f), filename)
+            for f, filename in zip(df['filename'], filenames)
+            if not os.path.exists(filename + '.npy')
+        ]
+        jobs = [tuple(zip(*job)) for job in chunks(todo, args.batch_size)]
+        with tqdm.tqdm(total=len(df), initial=len(df) - len(todo), desc='Melspects') as pbar:
+            for count in run_jobs(extract_and_save, jobs, args.num_workers):
+                pbar.update(count)
+        df.set_index('filename', inplace=True)
+        features = pd.DataFrame(
+            data=filenames,
+            index=df.index,
+            columns=['features']
         )
-        if fs != 16000:
-            audio = torchaudio.transforms.Resample(fs, 16000)(torch.from_numpy(audio))
-        else:
-            audio = torch.from_numpy(audio)
-        logmel = transform(audio)
-        filename = os.path.join(args.dest, '{:012}'.format(counter))
-        np.save(filename, logmel)
-        filenames.append(filename)
-    df.set_index('filename', inplace=True)
-    features = pd.DataFrame(
-        data=filenames,
-        index=df.index,
-        columns=['features']
-    )
-    features.reset_index().to_csv(os.path.join(args.dest, 'features.csv'), index=False)
\ No newline at end of file
+        features.reset_index().to_csv(os.path.join(args.dest, 'features.csv'), index=False)
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import pandas as pd
+
+
+SCENE_CATEGORIES = {
+    'airport': 'indoor',
+    'shopping_mall': 'indoor',
+    'metro_station': 'indoor',
+    'park': 'outdoor',
+    'public_square': 'outdoor',
+    'street_pedestrian': 'outdoor',
+    'street_traffic': 'outdoor',
+    'bus': 'transportation',
+    'metro': 'transportation',
+    'tram': 'transportation',
+}
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'sharpnessasc')
+
+# parsed partitions of this process, keyed like the cache files
+_loaded = {}
+
+
+def get_scene_category(x):
+    if x not in SCENE_CATEGORIES:
+        raise NotImplementedError(f'{x} not supported.')
+    return SCENE_CATEGORIES[x]
+
+
+def parse_partition(path: str):
+    r"""Read a DCASE partition file and add stratification columns.
+
+    Adds ``scene_category``, ``city``, ``device``
+    and ``scene_code`` (code of ``scene_label`` among the sorted labels),
+    all computed with vectorized string operations.
+
+    Args:
+        path: path to a partition file, e.g. ``fold1_train.csv``
+    """
+    df = pd.read_csv(path, sep='\t')
+    df['scene_category'] = df['scene_label'].map(SCENE_CATEGORIES)
+    unknown = df.loc[df['scene_category'].isna(), 'scene_label']
+    if len(unknown) > 0:
+        raise NotImplementedError(f'{unknown.iloc[0]} not supported.')
+    # <scene>-<city>-<location>-<segment>-<device>.wav
+    parts = df['filename'].str.rsplit('/', n=1).str[-1].str.split('-')
+    df['city'] = parts.str[1]
+    df['device'] = parts.str[-1].str.split('.').str[0]
+    df['scene_code'] = pd.Categorical(
+        df['scene_label'], categories=sorted(df['scene_label'].unique())).codes
+    return df.set_index('filename')
+
+
+def _cache_file(path):
+    # keyed by location and modification time of the partition file
+    path = os.path.abspath(path)
+    key = hashlib.sha1(path.encode()).hexdigest()[:12]
+    return '{}-{}-{}'.format(
+        os.path.splitext(os.path.basename(path))[0],
+        key,
+        os.stat(path).st_mtime_ns
+    )
+
+
+def load_partition(path: str, cache_dir: str = CACHE_DIR):
+    r"""Parsed partition file, cached on disk and in memory.
+
+    The parsed frame is stored as parquet in ``cache_dir``
+    (pickle if no parquet engine is installed)
+    and reused as long as the partition file is not modified.
+
+    Args:
+        path: path to a partition file, e.g. ``fold1_train.csv``
+        cache_dir: folder to store parsed partitions in,
+            ``None`` disables the cache on disk
+    """
+    name = _cache_file(path)
+    if name not in _loaded:
+        df = None
+        if cache_dir is not None:
+            for ext, read in [('.parquet', pd.read_parquet), ('.pkl', pd.read_pickle)]:
+                cache_path = os.path.join(cache_dir, name + ext)
+                if os.path.exists(cache_path):
+                    df = read(cache_path)
+                    break
+        if df is None:
+            df = parse_partition(path)
+            if cache_dir is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp = os.path.join(cache_dir, '{}.tmp{}'.format(name, os.getpid()))
+                try:
+                    df.to_parquet(tmp)
+                    ext = '.parquet'
+                except ImportError:
+                    df.to_pickle(tmp)
+                    ext = '.pkl'
+                os.replace(tmp, os.path.join(cache_dir, name + ext))
+        _loaded[name] = df
+    return _loaded[name].copy()
+
+
+def load_dcase(root: str, cache_dir: str = CACHE_DIR):
+    r"""Train, dev and test partitions of DCASE-Task1 (fold 1).
+
+    The evaluation partition is parsed once and used for dev and test.
+
+    Args:
+        root: path to DCASE-Task1 data (containing ``evaluation_setup``)
+        cache_dir: folder to store parsed partitions in
+    """
+    df_train = load_partition(
+        os.path.join(root, 'evaluation_setup', 'fold1_train.csv'), cache_dir)
+    df_dev = load_partition(
+        os.path.join(root, 'evaluation_setup', 'fold1_evaluate.csv'), cache_dir)
+    return df_train, df_dev, df_dev.copy()
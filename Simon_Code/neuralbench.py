@@ -13,7 +13,7 @@ import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 from gradient_descent_the_ultimate_optimizer import gdtuo
-from sam import SAM
+from sam import SAM, SAM_VARIANTS
 import datetime
 import sys
 from multiprocessing import Queue, Process, Semaphore
@@ -89,7 +89,7 @@ class GlobalQueueActor:
 
 
 class ParallelActor:
-    def __init__(self, q: GlobalQueueActor, actor_num, data_root, device, run_name, results_path, features, feature_dir, pretrained_dir, custom_feature_path, state, base_folder, disable_progress_bar) -> None:
+    def __init__(self, q: GlobalQueueActor, actor_num, data_root, device, run_name, results_path, features, feature_dir, pretrained_dir, custom_feature_path, state, base_folder, disable_progress_bar, feature_cache=None, feature_cache_size=None, audio_cache=None, crops_per_clip=1, image_cache=None, device_loader=False, amp=None, keep_last=None, keep_every=None, micro_batch_size=None, fisher='sampled', fisher_samples=1, half_outputs=False) -> None:
         self.q = q
         self.actor_num = actor_num
 
@@ -104,6 +104,19 @@ class ParallelActor:
         self.state = state
         self.base_folder = base_folder
         self.disable_progress_bar = disable_progress_bar
+        self.feature_cache = feature_cache
+        self.feature_cache_size = feature_cache_size
+        self.audio_cache = audio_cache
+        self.crops_per_clip = crops_per_clip
+        self.image_cache = image_cache
+        self.device_loader = device_loader
+        self.amp = amp
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.micro_batch_size = micro_batch_size
+        self.fisher = fisher
+        self.fisher_samples = fisher_samples
+        self.half_outputs = half_outputs
 
     def run_parallel(self):
         while True:
@@ -138,6 +151,19 @@ class ParallelActor:
                     exclude_cities=experiment[9],
                     base_folder=self.base_folder,
                     disable_progress_bar=self.disable_progress_bar,
+                    feature_cache=self.feature_cache,
+                    feature_cache_size=self.feature_cache_size,
+                    audio_cache=self.audio_cache,
+                    crops_per_clip=self.crops_per_clip,
+                    image_cache=self.image_cache,
+                    device_loader=self.device_loader,
+                    amp=self.amp,
+                    keep_last=self.keep_last,
+                    keep_every=self.keep_every,
+                    micro_batch_size=self.micro_batch_size,
+                    fisher=self.fisher,
+                    fisher_samples=self.fisher_samples,
+                    half_outputs=self.half_outputs,
                 )
                 try:
                     accuracy_history, uar_history, f1_history, train_loss_history, valid_loss_history, run_name_history = run.run()
@@ -272,15 +298,25 @@ class OptimizerWrapper:
         return self.optimizer_type.__name__
 
 class SAMWrapper:
-    def __init__(self, optimizer_type: callable, **optimizer_kwargs) -> None:
+    def __init__(self, optimizer_type: callable, variant: str = "sam", **optimizer_kwargs) -> None:
+        """Wrapper for SAM and its cheaper variants.
+
+        Args:
+            optimizer_type (callable): Base optimizer class.
+            variant (str, optional): One of "sam", "looksam" (perturbation every k steps) or "esam" (perturbation on random subsets). Defaults to "sam".
+            optimizer_kwargs (**kwargs): Additional keyword arguments to be passed to the SAM variant and the base optimizer.
+        """
+        if variant not in SAM_VARIANTS:
+            raise ValueError(f"Unknown SAM variant {variant}, choose from {list(SAM_VARIANTS)}.")
         self.optimizer_type = optimizer_type
+        self.variant = variant
         self.optimizer_kwargs = optimizer_kwargs
 
-    def create(self, model: torch.nn.Module, lr: float, device) -> gdtuo.ModuleWrapper:
+    def create(self, model: torch.nn.Module, lr: float, device) -> SAM:
         self.optimizer_kwargs["lr"] = lr
         # if self.get_name() in ["KFACOptimizer", "EKFACOptimizer"]:
             #return self.optimizer_type(model, **self.optimizer_kwargs)
-        return SAM(model.parameters(), self.optimizer_type, **self.optimizer_kwargs)
+        return SAM_VARIANTS[self.variant](model.parameters(), self.optimizer_type, **self.optimizer_kwargs)
         #return self.optimizer_type(model.parameters(), **self.optimizer_kwargs)
         
     def get_params(self) -> dict:
@@ -297,7 +333,7 @@ class SAMWrapper:
         Returns:
             str: Name.
         """
-        return "SAM"
+        return SAM_VARIANTS[self.variant].__name__
 
 
 
@@ -507,7 +543,20 @@ class NeuralBench():
                                          List[ShedulerWrapper]] = None,
                  exclude_cities: List[List[str]] = None,
                  base_folder: str = None,
-                 disable_progress_bar=False
+                 disable_progress_bar=False,
+                 feature_cache: str = None,
+                 feature_cache_size: float = None,
+                 audio_cache: str = None,
+                 crops_per_clip: int = 1,
+                 image_cache: str = None,
+                 device_loader: bool = False,
+                 amp: str = None,
+                 keep_last: int = None,
+                 keep_every: int = None,
+                 micro_batch_size: int = None,
+                 fisher: str = "sampled",
+                 fisher_samples: int = 1,
+                 half_outputs: bool = False
                  ) -> None:
         """Create a Training Configuration
 
@@ -530,6 +579,19 @@ class NeuralBench():
             exclude_cities (List[str], optional): List of cities to exclude from training data. Defaults to None.
             base_folder (str, optional): Base folder for "data_root", "run_name", "features" and "custom_feature_path". Defaults to None.
             disable_progress_bar (bool, optional): Disable tqdm progress bar while training. Defaults to False.
+            feature_cache (str, optional): Shared-memory folder features are packed into and loaded from, e.g. "/dev/shm/sharpnessasc". Defaults to None.
+            feature_cache_size (float, optional): Size of the feature cache in GB, least recently used feature sets are evicted. Defaults to None.
+            audio_cache (str, optional): Decoded int16 audio store used by sincnet, packed from "data_root" if missing. Defaults to None.
+            crops_per_clip (int, optional): Random crops drawn per clip and fetch by sincnet. Defaults to 1.
+            image_cache (str, optional): Folder to store transformed CIFAR10 images in. Defaults to None.
+            device_loader (bool, optional): Keep cached CIFAR10 images on the device and batch them there. Defaults to False.
+            amp (str, optional): Train with automatic mixed precision ("fp16" or "bf16"). Defaults to None.
+            keep_last (int, optional): Keep the states of the last K epochs only, the best state is always kept. Defaults to None.
+            keep_every (int, optional): Additionally keep the state of every N-th epoch. Defaults to None.
+            micro_batch_size (int, optional): Accumulate the gradients of each batch over micro-batches of this size, halved automatically when running out of GPU memory. Defaults to None.
+            fisher (str, optional): Statistics of (E)KFAC from targets sampled from the predictions ("sampled") or from the training targets ("empirical"). Defaults to "sampled".
+            fisher_samples (int, optional): Targets sampled per input for the statistics of (E)KFAC. Defaults to 1.
+            half_outputs (bool, optional): Write the test outputs (outputs.npy) as float16. Defaults to False.
         """
         if base_folder is None:
             base_folder = ""
@@ -571,6 +633,19 @@ class NeuralBench():
         self.args.train_timer = self.train_timer
         self.args.valid_timer = self.valid_timer
         self.args.disable_progress_bar = disable_progress_bar
+        self.args.feature_cache = feature_cache
+        self.args.feature_cache_size = feature_cache_size
+        self.args.audio_cache = audio_cache
+        self.args.crops_per_clip = crops_per_clip
+        self.args.image_cache = image_cache
+        self.args.device_loader = device_loader
+        self.args.amp = amp
+        self.args.keep_last = keep_last
+        self.args.keep_every = keep_every
+        self.args.micro_batch_size = micro_batch_size
+        self.args.fisher = fisher
+        self.args.fisher_samples = fisher_samples
+        self.args.half_outputs = half_outputs
 
         if isinstance(self.args.sheduler_wrapper, list):
             self.args.sheduler_name = "-".join(
@@ -736,6 +811,19 @@ class GridSearchModule:
                  base_folder: str = None,
                  disable_progress_bar=False,
                  num_gpus: int = 1,
+                 feature_cache: str = None,
+                 feature_cache_size: float = None,
+                 audio_cache: str = None,
+                 crops_per_clip: int = 1,
+                 image_cache: str = None,
+                 device_loader: bool = False,
+                 amp: str = None,
+                 keep_last: int = None,
+                 keep_every: int = None,
+                 micro_batch_size: int = None,
+                 fisher: str = "sampled",
+                 fisher_samples: int = 1,
+                 half_outputs: bool = False,
                  ) -> None:
         """Grid Search of NeuralBench over all possible permutations.
 
@@ -760,11 +848,25 @@ class GridSearchModule:
             base_folder (str, optional): Base folder for "data_root", "run_name", "features" and "custom_feature_path". Defaults to None.
             disable_progress_bar (bool, optional): Disable tqdm progress bar while training. Defaults to False.
             num_gpus (int, optional): Number of parallel GPUs to be used. Defaults to 1.
+            feature_cache (str, optional): Shared-memory folder features are packed into once and loaded from by all runs, e.g. "/dev/shm/sharpnessasc". Defaults to None.
+            feature_cache_size (float, optional): Size of the feature cache in GB, least recently used feature sets are evicted. Defaults to None.
+            audio_cache (str, optional): Decoded int16 audio store used by sincnet, packed from "data_root" if missing. Defaults to None.
+            crops_per_clip (int, optional): Random crops drawn per clip and fetch by sincnet. Defaults to 1.
+            image_cache (str, optional): Folder to store transformed CIFAR10 images in, shared by all runs. Defaults to None.
+            device_loader (bool, optional): Keep cached CIFAR10 images on the device and batch them there. Defaults to False.
+            amp (str, optional): Train with automatic mixed precision ("fp16" or "bf16"). Defaults to None.
+            keep_last (int, optional): Keep the states of the last K epochs of every run only, the best state is always kept. Defaults to None.
+            keep_every (int, optional): Additionally keep the state of every N-th epoch. Defaults to None.
+            micro_batch_size (int, optional): Accumulate the gradients of each batch over micro-batches of this size, halved automatically when running out of GPU memory. Defaults to None.
+            fisher (str, optional): Statistics of (E)KFAC from targets sampled from the predictions ("sampled") or from the training targets ("empirical"). Defaults to "sampled".
+            fisher_samples (int, optional): Targets sampled per input for the statistics of (E)KFAC. Defaults to 1.
+            half_outputs (bool, optional): Write the test outputs (outputs.npy) as float16. Defaults to False.
         """
 
         self.data_root = data_root
         self.device = device
         self.features = features
+        self.feature_dir = feature_dir
         self.pretrained_dir = pretrained_dir
         self.results_path = results_path
         self.custom_feature_path = custom_feature_path
@@ -802,6 +904,19 @@ class GridSearchModule:
         self.run_name_history = []
         self.permutations = None
         self.num_gpus = num_gpus
+        self.feature_cache = feature_cache
+        self.feature_cache_size = feature_cache_size
+        self.audio_cache = audio_cache
+        self.crops_per_clip = crops_per_clip
+        self.image_cache = image_cache
+        self.device_loader = device_loader
+        self.amp = amp
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.micro_batch_size = micro_batch_size
+        self.fisher = fisher
+        self.fisher_samples = fisher_samples
+        self.half_outputs = half_outputs
 
     def generate_permutations(self):
         self.permutations = list(product(*self.grid))
@@ -997,6 +1112,7 @@ class GridSearchModule:
                 run_name=None,
                 results_path=self.results_path,
                 features=self.features,
+                feature_dir=self.feature_dir,
                 pretrained_dir=self.pretrained_dir,
                 custom_feature_path=self.custom_feature_path,
                 state=self.state,
@@ -1013,6 +1129,19 @@ class GridSearchModule:
                 exclude_cities=experiment[10],
                 base_folder=self.base_folder,
                 disable_progress_bar=self.disable_progress_bar,
+                feature_cache=self.feature_cache,
+                feature_cache_size=self.feature_cache_size,
+                audio_cache=self.audio_cache,
+                crops_per_clip=self.crops_per_clip,
+                image_cache=self.image_cache,
+                device_loader=self.device_loader,
+                amp=self.amp,
+                keep_last=self.keep_last,
+                keep_every=self.keep_every,
+                micro_batch_size=self.micro_batch_size,
+                fisher=self.fisher,
+                fisher_samples=self.fisher_samples,
+                half_outputs=self.half_outputs,
             )
             # TODO: for the end; Get back the try except block 
             accuracy_history, uar_history, f1_history, train_loss_history, valid_loss_history, run_name_history = run.run()
@@ -1072,11 +1201,23 @@ class GridSearchModule:
                     self.features,
                     self.feature_dir,
                     self.pretrained_dir,
-                    self.pretrained,
                     self.custom_feature_path,
                     self.state,
                     self.base_folder,
-                    self.disable_progress_bar
+                    self.disable_progress_bar,
+                    feature_cache=self.feature_cache,
+                    feature_cache_size=self.feature_cache_size,
+                    audio_cache=self.audio_cache,
+                    crops_per_clip=self.crops_per_clip,
+                    image_cache=self.image_cache,
+                    device_loader=self.device_loader,
+                    amp=self.amp,
+                    keep_last=self.keep_last,
+                    keep_every=self.keep_every,
+                    micro_batch_size=self.micro_batch_size,
+                    fisher=self.fisher,
+                    fisher_samples=self.fisher_samples,
+                    half_outputs=self.half_outputs
                 )
                 processes.append(Process(target=a.run_parallel))
 
@@ -1,8 +1,53 @@
 import torch
 
 
+def _foreach_copy_(targets, sources):
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(targets, sources)
+    else:
+        for target, source in zip(targets, sources):
+            target.copy_(source)
+
+
+def _foreach_scale_(tensors, scale):
+    # the overload taking a tensor scale needs torch>=2.1, older versions loop
+    try:
+        torch._foreach_mul_(tensors, scale)
+    except TypeError:
+        for tensor in tensors:
+            tensor.mul_(scale)
+
+
+def _foreach_scaled(tensors, scale):
+    try:
+        return torch._foreach_mul(tensors, scale)
+    except TypeError:
+        return [tensor * scale for tensor in tensors]
+
+
+def _global_norm(tensors, device):
+    return torch.norm(torch.stack([norm.to(device) for norm in torch._foreach_norm(tensors)]), p=2)
+
+
 class SAM(torch.optim.Optimizer):
-    def __init__(self, params, base_optimizer, rho=0.05, adaptive=False, **kwargs):
+    r"""Sharpness-Aware Minimization with multi-tensor (``torch._foreach_*``) updates.
+
+    The perturbation ``e(w)`` and (unless ``store_perturbation``) the weights
+    are kept in buffers allocated once per parameter.
+    Restoring from the perturbation saves the copy of the weights,
+    but ``w + e(w) - e(w)`` is only equal to ``w`` up to rounding.
+
+    The cost of a step is counted in forward-backward passes over a full batch
+    (2 for SAM, 1 for the base optimizer), see :meth:`cost`.
+    ``steps`` counts all steps (e.g. for the schedule of :class:`LookSAM`),
+    it is not reset with the cost.
+    Subclasses make steps cheaper by overriding
+    :meth:`ascent_step`, :meth:`ascent_indices` and :meth:`_ascent_params`.
+    """
+    # per-parameter buffers kept in the state dict, see :meth:`state_dict`
+    persistent_state = ()
+
+    def __init__(self, params, base_optimizer, rho=0.05, adaptive=False, store_perturbation=False, **kwargs):
         assert rho >= 0.0, f"Invalid rho, should be non-negative: {rho}"
 
         defaults = dict(rho=rho, adaptive=adaptive, **kwargs)
@@ -11,32 +56,113 @@ class SAM(torch.optim.Optimizer):
         self.base_optimizer = base_optimizer(self.param_groups, **kwargs)
         self.param_groups = self.base_optimizer.param_groups
         self.defaults.update(self.base_optimizer.defaults)
+        self.store_perturbation = store_perturbation
+        self.steps = 0
+        self.cost_steps = 0
+        self.passes = 0.
+        self.ascent_fraction = 1.
+        # parameters perturbed by the last first_step, per group
+        self.perturbed = []
+
+    def _params_with_grad(self, group):
+        params = [p for p in group["params"] if p.grad is not None]
+        return params, [p.grad for p in params]
+
+    def _ascent_params(self, params, grads):
+        r"""Parameters (and their gradients) to perturb."""
+        return params, grads
+
+    def _buffers(self, params, key):
+        # allocated on the first step and reused afterwards
+        buffers = []
+        for p in params:
+            state = self.state[p]
+            if key not in state:
+                state[key] = torch.empty_like(p)
+            buffers.append(state[key])
+        return buffers
+
+    def ascent_step(self):
+        r"""Whether the current step computes a new perturbation,
+        otherwise the train step calls :meth:`reuse_step` after a single pass."""
+        return True
+
+    def ascent_indices(self, batch_size):
+        r"""Samples of the batch to compute the perturbation on, ``None`` for all."""
+        self.ascent_fraction = 1.
+        return None
+
+    def cost(self):
+        r"""Mean number of forward-backward passes per step."""
+        return self.passes / max(self.cost_steps, 1)
+
+    def reset_cost(self):
+        self.cost_steps = 0
+        self.passes = 0.
 
     @torch.no_grad()
-    def first_step(self, zero_grad=False):
-        grad_norm = self._grad_norm()
-        for group in self.param_groups:
+    def first_step(self, zero_grad=False, scaler=None):
+        # e(w) is invariant to the loss scale of a GradScaler,
+        # but overflowed gradients must not perturb the weights
+        check_finite = scaler is not None and scaler.is_enabled()
+        selected = [
+            self._ascent_params(*self._params_with_grad(group))
+            for group in self.param_groups
+        ]
+        grad_norm = self._grad_norm(selected)
+        self.perturbed = []
+        for group, (params, grads) in zip(self.param_groups, selected):
+            self.perturbed.append(params)
+            if not params: continue
             scale = group["rho"] / (grad_norm + 1e-12)
-            
-            for p in group["params"]:
-                if p.grad is None: continue
-                self.state[p]["old_p"] = p.data.clone()
-                e_w = (torch.pow(p, 2) if group["adaptive"] else 1.0) * p.grad * scale.to(p)
-                p.add_(e_w)  # climb to the local maximum "w + e(w)"
+
+            if not self.store_perturbation:
+                _foreach_copy_(self._buffers(params, "old_p"), params)
+            e_w = self._buffers(params, "e_w")
+            _foreach_copy_(e_w, grads)
+            if group["adaptive"]:
+                torch._foreach_mul_(e_w, params)
+                torch._foreach_mul_(e_w, params)
+            _foreach_scale_(e_w, scale.to(params[0]))
+            if check_finite:
+                for e in e_w:
+                    torch.nan_to_num_(e, nan=0.0, posinf=0.0, neginf=0.0)
+            torch._foreach_add_(params, e_w)  # climb to the local maximum "w + e(w)"
+        self.passes += self.ascent_fraction
 
         if zero_grad: self.zero_grad()
 
     @torch.no_grad()
-    def second_step(self, zero_grad=False):
-        for group in self.param_groups:
-            for p in group["params"]:
-                if p.grad is None: continue
-                p.data = self.state[p]["old_p"]  # get back to "w" from "w + e(w)"
+    def restore(self):
+        r"""Undo the perturbation of :meth:`first_step`, also after a failed pass."""
+        for params in self.perturbed:
+            if not params: continue
+            # get back to "w" from "w + e(w)"
+            if self.store_perturbation:
+                torch._foreach_sub_(params, self._buffers(params, "e_w"))
+            else:
+                _foreach_copy_(params, self._buffers(params, "old_p"))
+        self.perturbed = []
 
-        self.base_optimizer.step()  # do the actual "sharpness-aware" update
+    @torch.no_grad()
+    def second_step(self, zero_grad=False, scaler=None):
+        self.restore()
+        self._base_step(scaler)
 
         if zero_grad: self.zero_grad()
 
+    def _base_step(self, scaler):
+        # do the actual "sharpness-aware" update
+        if scaler is None:
+            self.base_optimizer.step()
+        else:
+            # unscales the gradients and skips the update if they overflowed,
+            # the caller updates the scaler once per iteration
+            scaler.step(self.base_optimizer)
+        self.passes += 1
+        self.steps += 1
+        self.cost_steps += 1
+
     @torch.no_grad()
     def step(self, closure=None):
         assert closure is not None, "Sharpness Aware Minimization requires closure, but it was not provided"
@@ -46,18 +172,161 @@ class SAM(torch.optim.Optimizer):
         closure()
         self.second_step()
 
-    def _grad_norm(self):
+    def _grad_norm(self, selected=None):
         shared_device = self.param_groups[0]["params"][0].device  # put everything on the same device, in case of model parallelism
-        norm = torch.norm(
-                    torch.stack([
-                        ((torch.abs(p) if group["adaptive"] else 1.0) * p.grad).norm(p=2).to(shared_device)
-                        for group in self.param_groups for p in group["params"]
-                        if p.grad is not None
-                    ]),
-                    p=2
-               )
-        return norm
+        if selected is None:
+            selected = [self._params_with_grad(group) for group in self.param_groups]
+        norms = []
+        for group, (params, grads) in zip(self.param_groups, selected):
+            if not params: continue
+            if group["adaptive"]:
+                grads = torch._foreach_mul(torch._foreach_abs(params), grads)
+            norms.extend(norm.to(shared_device) for norm in torch._foreach_norm(grads))
+        return torch.norm(torch.stack(norms), p=2)
+
+    def state_dict(self):
+        state_dict = super().state_dict()
+        # "old_p" and "e_w" only live within a step,
+        # the state of the base optimizer (e.g. momentum) is needed to resume training
+        state_dict['state'] = {
+            index: {key: value for key, value in state.items() if key in self.persistent_state}
+            for index, state in state_dict['state'].items()
+            if any(key in self.persistent_state for key in state)
+        }
+        state_dict['base_optimizer'] = self.base_optimizer.state_dict()
+        state_dict['counters'] = {
+            'steps': self.steps,
+            'cost_steps': self.cost_steps,
+            'passes': self.passes
+        }
+        return state_dict
 
     def load_state_dict(self, state_dict):
+        state_dict = dict(state_dict)
+        base_state = state_dict.pop('base_optimizer', None)
+        counters = state_dict.pop('counters', None)
         super().load_state_dict(state_dict)
+        if base_state is not None:
+            self.base_optimizer.load_state_dict(base_state)
         self.base_optimizer.param_groups = self.param_groups
+        if counters is not None:
+            self.steps = counters['steps']
+            self.cost_steps = counters['cost_steps']
+            self.passes = counters['passes']
+
+
+class LookSAM(SAM):
+    r"""LookSAM, the perturbation is only computed every ``k`` steps.
+
+    On these steps the component of the SAM gradient
+    orthogonal to the plain gradient is stored,
+    in between it is added to the plain gradient
+    with ``alpha`` times the norm of the gradient (see Liu et al. 2022).
+
+    Args:
+        k: steps between two SAM steps
+        alpha: weight of the stored component
+    """
+    # the stored component is reused until the next SAM step, also after resuming
+    persistent_state = ('g_v',)
+
+    def __init__(self, params, base_optimizer, rho=0.05, adaptive=False, store_perturbation=False, k=5, alpha=0.7, **kwargs):
+        super(LookSAM, self).__init__(
+            params, base_optimizer, rho=rho, adaptive=adaptive,
+            store_perturbation=store_perturbation, **kwargs)
+        self.k = k
+        self.alpha = alpha
+
+    def ascent_step(self):
+        return self.steps % self.k == 0
+
+    @torch.no_grad()
+    def first_step(self, zero_grad=False, scaler=None):
+        for group in self.param_groups:
+            params, grads = self._params_with_grad(group)
+            if params:
+                _foreach_copy_(self._buffers(params, "g"), grads)
+        super(LookSAM, self).first_step(zero_grad=zero_grad, scaler=scaler)
+
+    @torch.no_grad()
+    def second_step(self, zero_grad=False, scaler=None):
+        # g_v = g_s - (g . g_s) / |g|^2 g, before the scaler unscales g_s
+        params = [
+            p for group in self.param_groups for p in group["params"]
+            if p.grad is not None and "g" in self.state[p]
+        ]
+        if params:
+            g = [self.state[p]["g"] for p in params]
+            g_s = [p.grad for p in params]
+            dot = torch.stack([
+                (a * b).sum().to(params[0].device) for a, b in zip(g, g_s)
+            ]).sum()
+            norm = _global_norm(g, params[0].device)
+            g_v = self._buffers(params, "g_v")
+            _foreach_copy_(g_v, g)
+            _foreach_scale_(g_v, -dot / (norm ** 2 + 1e-12))
+            torch._foreach_add_(g_v, g_s)
+            if scaler is not None and scaler.is_enabled():
+                for v in g_v:
+                    torch.nan_to_num_(v, nan=0.0, posinf=0.0, neginf=0.0)
+        super(LookSAM, self).second_step(zero_grad=zero_grad, scaler=scaler)
+
+    @torch.no_grad()
+    def reuse_step(self, zero_grad=False, scaler=None):
+        r"""Update with the plain gradient and the stored component."""
+        params = [
+            p for group in self.param_groups for p in group["params"]
+            if p.grad is not None and "g_v" in self.state[p]
+        ]
+        if params:
+            grads = [p.grad for p in params]
+            g_v = [self.state[p]["g_v"] for p in params]
+            scale = self.alpha * _global_norm(grads, params[0].device) / (
+                _global_norm(g_v, params[0].device) + 1e-12)
+            torch._foreach_add_(grads, _foreach_scaled(g_v, scale))
+        self._base_step(scaler)
+
+        if zero_grad: self.zero_grad()
+
+
+class ESAM(SAM):
+    r"""SAM with the perturbation computed on random subsets (see Du et al. 2022).
+
+    Args:
+        param_fraction: probability of every parameter tensor to be perturbed
+        batch_fraction: fraction of the batch used for the ascent pass
+    """
+
+    def __init__(self, params, base_optimizer, rho=0.05, adaptive=False, store_perturbation=False, param_fraction=0.5, batch_fraction=0.5, **kwargs):
+        super(ESAM, self).__init__(
+            params, base_optimizer, rho=rho, adaptive=adaptive,
+            store_perturbation=store_perturbation, **kwargs)
+        self.param_fraction = param_fraction
+        self.batch_fraction = batch_fraction
+
+    def ascent_indices(self, batch_size):
+        size = min(max(int(round(batch_size * self.batch_fraction)), 1), batch_size)
+        self.ascent_fraction = size / batch_size
+        if size == batch_size:
+            return None
+        return torch.randperm(batch_size)[:size]
+
+    def _ascent_params(self, params, grads):
+        if self.param_fraction >= 1 or not params:
+            return params, grads
+        # drawn on the host, no synchronization with the device
+        keep = torch.rand(len(params)) < self.param_fraction
+        if not keep.any():
+            keep[torch.randint(len(params), (1,))] = True
+        keep = keep.tolist()
+        return (
+            [p for p, k in zip(params, keep) if k],
+            [g for g, k in zip(grads, keep) if k]
+        )
+
+
+SAM_VARIANTS = {
+    'sam': SAM,
+    'looksam': LookSAM,
+    'esam': ESAM
+}
@@ -0,0 +1,68 @@
+import os
+
+import torch
+
+from checkpoint import CheckpointWriter
+
+
+def state_path(root, epoch):
+    folder = os.path.join(str(root), 'Epoch_{}'.format(epoch))
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, 'state.pth.tar')
+
+
+def run_epochs(checkpoints, root, metrics, start_epoch=0, best=(None, -1)):
+    r"""Save states and the resume file like the training loop."""
+    best_epoch, max_metric = best
+    resume_path = os.path.join(str(root), 'training_state.pth.tar')
+    for epoch, metric in enumerate(metrics, start=start_epoch + 1):
+        is_best = metric > max_metric
+        checkpoints.save_state(
+            {'weight': torch.full((2,), float(epoch))},
+            state_path(root, epoch), epoch, is_best=is_best, retain=False)
+        if is_best:
+            best_epoch, max_metric = epoch, metric
+        checkpoints.write({
+            'epoch': epoch,
+            'max_metric': max_metric,
+            'best_epoch': best_epoch,
+            'best_state': state_path(root, best_epoch)
+        }, resume_path)
+        checkpoints.retain()
+    checkpoints.wait()
+    return torch.load(resume_path)
+
+
+def test_retention_waits_for_the_resume_file(tmp_path):
+    checkpoints = CheckpointWriter(keep_last=1, pin_memory=False)
+    run_epochs(checkpoints, tmp_path, [0.5])
+    # interrupted between the new best state and its resume file
+    checkpoints.save_state(
+        {'weight': torch.full((2,), 2.)}, state_path(tmp_path, 2), 2, is_best=True, retain=False)
+    checkpoints.close()
+
+    resume = torch.load(os.path.join(str(tmp_path), 'training_state.pth.tar'))
+    assert resume['best_state'] == state_path(tmp_path, 1)
+    assert torch.load(resume['best_state'])['weight'].tolist() == [1., 1.]
+
+
+def test_retention_after_resume(tmp_path):
+    with CheckpointWriter(keep_last=1, pin_memory=False) as checkpoints:
+        resume = run_epochs(checkpoints, tmp_path, [0.5, 0.9, 0.7])
+    assert not os.path.exists(state_path(tmp_path, 1))
+    assert os.path.exists(resume['best_state'])
+
+    # states left on disk stay subject to the retention policy
+    with CheckpointWriter(keep_last=1, pin_memory=False) as checkpoints:
+        for epoch in range(1, resume['epoch'] + 1):
+            if os.path.exists(state_path(tmp_path, epoch)):
+                checkpoints.track(
+                    state_path(tmp_path, epoch), epoch, is_best=epoch == resume['best_epoch'])
+        resume = run_epochs(
+            checkpoints, tmp_path, [0.6], start_epoch=resume['epoch'],
+            best=(resume['best_epoch'], resume['max_metric']))
+
+    assert resume['best_epoch'] == 2
+    assert torch.load(resume['best_state'])['weight'].tolist() == [2., 2.]
+    assert not os.path.exists(state_path(tmp_path, 3))
+    assert os.path.exists(state_path(tmp_path, 4))
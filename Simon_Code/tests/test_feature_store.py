@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+import pickle
+
+import audiofile
+import numpy as np
+import pandas as pd
+
+from feature_store import (
+    AUDIO_SCALE,
+    PackedFeatureWriter,
+    PackedFeatures,
+    cache_features,
+    evict_features,
+    is_packed_store,
+    load_audio
+)
+
+
+def create_store(root, entries=4):
+    with PackedFeatureWriter(str(root)) as writer:
+        for index in range(entries):
+            writer.append('clip{}.wav'.format(index), np.full((2, 3), index, dtype=np.float32))
+    return PackedFeatures(str(root))
+
+
+def test_evict_skips_entries_in_use(tmp_path):
+    source = create_store(tmp_path / 'source')
+    cache_root = str(tmp_path / 'cache')
+    features = cache_features(str(tmp_path / 'source'), source, cache_root=cache_root)
+    expected = features[1].copy()
+
+    # another run needs the whole cache while this one still reads the entry
+    evict_features(cache_root, needed=1, capacity=0)
+    assert is_packed_store(features.root)
+    # DataLoader workers reopen the memory map every epoch
+    worker_copy = pickle.loads(pickle.dumps(features))
+    np.testing.assert_array_equal(worker_copy[1], expected)
+
+    features.close()
+    evict_features(cache_root, needed=1, capacity=0)
+    assert not os.path.exists(features.root)
+
+
+def test_writer_resumes_partial_store(tmp_path):
+    root = str(tmp_path / 'store')
+    with PackedFeatureWriter(root) as writer:
+        writer.append('clip0.wav', np.zeros((2, 3), dtype=np.float32))
+    with PackedFeatureWriter(root, resume=True) as writer:
+        assert writer.filenames == {'clip0.wav'}
+        writer.append('clip1.wav', np.ones((2, 3), dtype=np.float32))
+    features = PackedFeatures(root)
+    assert list(features.filenames) == ['clip0.wav', 'clip1.wav']
+    np.testing.assert_array_equal(features[1], np.ones((2, 3)))
+
+
+def packed_entries(args):
+    dest, root = args
+    audio = load_audio(dest, root)
+    return list(audio.filenames), [audio[row].copy() for row in range(len(audio))]
+
+
+def test_concurrent_packing(tmp_path):
+    root = str(tmp_path / 'audio')
+    os.makedirs(os.path.join(root, 'audio'))
+    filenames = ['audio/clip{}.wav'.format(index) for index in range(8)]
+    rng = np.random.default_rng(0)
+    for filename in filenames:
+        audiofile.write(
+            os.path.join(root, filename), rng.uniform(-0.5, 0.5, 1600), 16000)
+    pd.DataFrame({'filename': filenames}).to_csv(
+        os.path.join(root, 'meta.csv'), sep='\t', index=False)
+
+    # several runs starting on the same unpacked store
+    dest = str(tmp_path / 'packed')
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        results = pool.map(packed_entries, [(dest, root)] * 4)
+
+    assert not os.path.exists(dest + '.tmp')
+    for names, entries in results:
+        assert names == filenames
+        for filename, entry in zip(filenames, entries):
+            signal = audiofile.read(os.path.join(root, filename), always_2d=False)[0]
+            np.testing.assert_array_equal(entry, np.round(signal * AUDIO_SCALE))
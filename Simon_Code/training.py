@@ -10,7 +10,24 @@ from models import (
 )
 from datasets import (
     CachedDataset,
-    WavDataset
+    WavDataset,
+    WindowBatch,
+    DeviceLoader,
+    cache_images,
+    collate_batch,
+    collate_crops,
+    collate_windows
+)
+from metadata import load_dcase
+from checkpoint import (
+    CheckpointWriter,
+    rng_state,
+    set_rng_state
+)
+from feature_store import (
+    cache_features,
+    load_audio,
+    load_features
 )
 from utils import (
     disaggregated_evaluation,
@@ -19,14 +36,16 @@ from utils import (
     LabelEncoder,
     get_output_dim,
     get_df_from_dataset,
-    GrayscaleToRGB
+    FeatureTransfer,
+    ExpandChannels,
+    LossMeter,
+    MixedPrecision,
+    FULL_PRECISION
 )
 #from ml_utils import get_sharpness
 from torch.utils.tensorboard import SummaryWriter
 import torchvision
-import torchvision.transforms as transforms
 import argparse
-import audtorch
 import numpy as np
 import os
 import pandas as pd
@@ -36,7 +55,7 @@ import torch
 import copy
 import tqdm
 import yaml
-from KFACPytorch import KFACOptimizer, EKFACOptimizer
+from KFACPytorch import KFACOptimizer, EKFACOptimizer, FisherSampler
 from sam import SAM
 from calculate_different_sharpness_values import calculate_sharpness
 from gradient_descent_the_ultimate_optimizer.gdtuo import ModuleWrapper, NoOpOptimizer
@@ -63,23 +82,57 @@ def replace_file_path(df: pd.DataFrame, col, new_path):
 
 
 class Model(torch.nn.Module):
-    def __init__(self, cnn, mlp_1, mlp_2, wlen, wshift):
+    def __init__(self, cnn, mlp_1, mlp_2, wlen, wshift, max_windows=1024):
         super().__init__()
         self.cnn = cnn
         self.mlp_1 = mlp_1
         self.mlp_2 = mlp_2
         self.wlen = wlen
         self.wshift = wshift
+        # windows passed through the network at once during evaluation
+        self.max_windows = max_windows
         self.output_dim = self.mlp_2.fc_lay[-1]
 
+    def _forward(self, x):
+        return self.mlp_2(self.mlp_1(self.cnn(x)))
+
+    def _window_chunks(self, signals, lengths):
+        # windows of all clips, packed into chunks of at most max_windows
+        chunk = []
+        size = 0
+        start = 0
+        for length in lengths.tolist():
+            windows = signals[start:start + length].unfold(0, self.wlen, self.wshift)
+            start += length
+            for part in windows.split(self.max_windows):
+                if size + len(part) > self.max_windows and chunk:
+                    yield torch.cat(chunk)
+                    chunk = []
+                    size = 0
+                chunk.append(part)
+                size += len(part)
+        if chunk:
+            yield torch.cat(chunk)
+
     def forward(self, x):
         # x = x.transpose(1, 2)
-        if not self.training:
-            x = x.unfold(1, self.wlen, self.wshift).squeeze(0)
-        out = self.mlp_2(self.mlp_1(self.cnn(x)))
-        if not self.training:
-            out = out.mean(0, keepdim=True)
-        return out
+        if self.training:
+            return self._forward(x)
+        # evaluation: mean output over the sliding windows of every clip
+        if isinstance(x, WindowBatch):
+            signals, lengths = x.signals, x.lengths
+        else:
+            signals = x.reshape(-1)
+            lengths = torch.full((len(x),), x.shape[-1])
+        out = torch.cat([
+            self._forward(windows)
+            for windows in self._window_chunks(signals, lengths)
+        ])
+        counts = ((lengths - self.wlen) // self.wshift + 1).to(out.device)
+        segments = torch.repeat_interleave(
+            torch.arange(len(counts), device=out.device), counts)
+        out = out.new_zeros(len(counts), out.shape[-1]).index_add_(0, segments, out)
+        return out / counts.unsqueeze(1).to(out.dtype)
 
 
 def train_step_gdtuo(model,
@@ -90,13 +143,17 @@ def train_step_gdtuo(model,
                      device,
                      clip_net=1.,
                      clip_opt=1.,
+                     transfer_func=transfer_features,
+                     amp=FULL_PRECISION,
                      ):
     # * Train Step for GDTUO Optimizer using ModelWrapper
     # ? Reference: https://github.com/kach/gradient-descent-the-ultimate-optimizer
+    # * Only autocast, loss scaling does not support the hypergradients
     mw.begin()
-    output = mw.forward(transfer_features(features, device))
-    targets = targets.to(device)
-    loss = criterion(output, targets)
+    with amp.autocast():
+        output = mw.forward(transfer_func(features, device))
+        targets = targets.to(device)
+        loss = criterion(output, targets)
     mw.zero_grad()
     loss.backward(create_graph=True)  # important! use create_graph=True
     # * GDTUO needs gradient clipping, a lot of stacked optimizers cause HUUUGE gradients!
@@ -114,7 +171,8 @@ def train_step_gdtuo(model,
                 param.grad = torch.maximum(param.grad, -_clip)
             opt = opt.optimizer
     mw.step()
-    _loss = loss.item()
+    # * kept on the device, see LossMeter
+    _loss = loss.detach()
     # * GDTUO leaks memory, so it needs to be dealt with manually!
     opt = mw
     while not isinstance(opt, NoOpOptimizer):
@@ -127,62 +185,155 @@ def train_step_gdtuo(model,
     return _loss
 
 
-def train_step_kfac(model, optimizer, criterion, features, targets, device, _epoch, _batch):
+# * one target drawn from the predictions per input, see FisherSampler
+TRUE_FISHER = FisherSampler()
+
+
+def train_step_kfac(model, optimizer, criterion, features, targets, device, _epoch, _batch, transfer_func=transfer_features, amp=FULL_PRECISION, fisher=TRUE_FISHER):
     # * Train Step for (E)KFAC Optimizer
     # ? Reference: https://github.com/alecwangcq/KFAC-Pytorch    
     optimizer.zero_grad()
-    output = model(transfer_features(features, device))
-    targets = targets.to(device)
-    loss = criterion(output, targets)
+    with amp.autocast():
+        output = model(transfer_func(features, device))
+        targets = targets.to(device)
+        loss = criterion(output, targets)
     if optimizer.steps % optimizer.TCov == 0:
-        # compute true fisher
-        optimizer.acc_stats = True
-        with torch.no_grad():
-            sampled_y = torch.multinomial(torch.nn.functional.softmax(output.cpu().data, dim=1),
-                                          1).squeeze().cuda()
-        loss_sample = criterion(output, sampled_y)
-        loss_sample.backward(retain_graph=True)
-        optimizer.acc_stats = False
-        optimizer.zero_grad()  # clear the gradient for computing true-fisher.
-    loss.backward()
-    optimizer.step()
-    _loss = loss.item()
-    return _loss
-
-
-def train_step_normal(model, optimizer, criterion, features, targets, device):
+        # * the hooks divide the scaled gradients by grad_scale, statistics stay in fp32
+        optimizer.grad_scale = amp.scaler.get_scale() if amp.scaler.is_enabled() else 1.
+        if fisher.empirical:
+            # * statistics of the training loss are collected in its backward pass
+            optimizer.acc_stats = True
+        else:
+            # compute true fisher, targets are sampled on the device
+            fisher.backward(optimizer, criterion, output, amp.scaler)
+            optimizer.zero_grad()  # clear the gradient for computing true-fisher.
+    amp.scaler.scale(loss).backward()
+    optimizer.acc_stats = False
+    amp.scaler.step(optimizer)
+    amp.scaler.update()
+    # * kept on the device, see LossMeter
+    return loss.detach()
+
+
+def accumulate_gradients(model, criterion, features, targets, amp=FULL_PRECISION, micro_batch_size=None):
+    r"""Forward-backward pass over a batch in micro-batches.
+
+    The loss of every micro-batch is weighted by its share of the batch,
+    so the accumulated gradients equal those of a single pass
+    (up to batch statistics, e.g. of batch normalization).
+    Returns the detached loss of the whole batch.
+
+    Args:
+        micro_batch_size: maximum samples per pass,
+            ``None`` runs the whole batch at once
+    """
+    if micro_batch_size is None or micro_batch_size >= len(targets):
+        chunks = [(features, targets)]
+    else:
+        chunks = zip(features.split(micro_batch_size), targets.split(micro_batch_size))
+    total = 0
+    for chunk_features, chunk_targets in chunks:
+        with amp.autocast():
+            loss = criterion(model(chunk_features), chunk_targets) * (len(chunk_targets) / len(targets))
+        amp.scaler.scale(loss).backward()
+        total = total + loss.detach()
+    return total
+
+
+class MicroBatches:
+    r"""Micro-batch size of the forward-backward passes of a run.
+
+    The size is halved whenever a pass runs out of GPU memory
+    and the failed pass is repeated with the smaller micro-batches.
+    Only the passes are retried, before any scaler or optimizer step,
+    and the batch normalization buffers they updated are restored first.
+
+    Args:
+        size: maximum samples per pass,
+            ``None`` runs the whole batch at once
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+
+    def accumulate(self, model, criterion, features, targets, amp=FULL_PRECISION):
+        r"""Like :func:`accumulate_gradients`, retrying on out-of-memory errors."""
+        buffers = [
+            buffer
+            for module in model.modules()
+            if isinstance(module, torch.nn.modules.batchnorm._BatchNorm)
+            for buffer in module.buffers()
+        ]
+        snapshot = [buffer.clone() for buffer in buffers]
+        while True:
+            try:
+                return accumulate_gradients(
+                    model, criterion, features, targets, amp=amp, micro_batch_size=self.size)
+            except torch.cuda.OutOfMemoryError:
+                size = min(self.size or len(targets), len(targets)) // 2
+                if size < 1:
+                    raise
+                self.size = size
+            # * memory of the failed pass is released once the exception is cleared
+            with torch.no_grad():
+                for buffer, saved in zip(buffers, snapshot):
+                    buffer.copy_(saved)
+            # * drop the gradients of the finished micro-batches,
+            # * and any per-iteration state of the scaler with them
+            model.zero_grad(set_to_none=True)
+            if amp.scaler.is_enabled():
+                amp.scaler._per_optimizer_states.clear()
+            torch.cuda.empty_cache()
+            print(f'Out of GPU memory, using micro-batches of {self.size} samples')
+
+
+def train_step_normal(model, optimizer, criterion, features, targets, device, transfer_func=transfer_features, amp=FULL_PRECISION, micro_batches=None):
     # * Train Step for Torch Base Optimizers
     # print("-"*50)
     # TODO: Remove this part. It's only for testing.
     # sharp = get_sharpness(mode, train_dataset)
     # print("Sharpness: ", sharp)
     # print("Feature Shapes: ", features.shape)
-    output = model(transfer_features(features, device))
-    targets = targets.to(device)
-    loss = criterion(output, targets)
+    micro_batches = micro_batches or MicroBatches()
     optimizer.zero_grad()
-    loss.backward()
-    optimizer.step()
-    _loss = loss.item()
-    return _loss
-
-def train_step_SAM(model, optimizer, criterion, features, targets, device):
+    loss = micro_batches.accumulate(
+        model, criterion, transfer_func(features, device), targets.to(device), amp=amp)
+    amp.scaler.step(optimizer)
+    amp.scaler.update()
+    # * kept on the device, see LossMeter
+    return loss.detach()
+
+def train_step_SAM(model, optimizer, criterion, features, targets, device, transfer_func=transfer_features, amp=FULL_PRECISION, micro_batches=None):
     # * Train Step for SAM optimizer
-    output = model(transfer_features(features, device))
+    # * both passes share one loss scale, the scaler is updated once per step
+    micro_batches = micro_batches or MicroBatches()
+    features = transfer_func(features, device)
     targets = targets.to(device)
-    # first forward-backward pass
-    loss = criterion(output, targets)  # use this loss for any training statistics
-    loss.backward()
-    optimizer.first_step(zero_grad=True)
+    if not optimizer.ascent_step():
+        # * cheaper SAM variants (LookSAM) reuse the last perturbation with a single pass
+        optimizer.zero_grad()
+        loss = micro_batches.accumulate(model, criterion, features, targets, amp=amp)
+        optimizer.reuse_step(zero_grad=True, scaler=amp.scaler)
+        amp.scaler.update()
+        return loss.detach()
+
+    # first forward-backward pass, possibly on a subset of the batch (ESAM)
+    indices = optimizer.ascent_indices(len(targets))
+    ascent_features, ascent_targets = features, targets
+    if indices is not None:
+        indices = indices.to(targets.device)
+        ascent_features, ascent_targets = features[indices], targets[indices]
+    optimizer.zero_grad()
+    micro_batches.accumulate(model, criterion, ascent_features, ascent_targets, amp=amp)
+    optimizer.first_step(zero_grad=True, scaler=amp.scaler)
     
-    # second forward-backward pass
-    output = model(transfer_features(features, device))
-    targets = targets.to(device)
-    loss = criterion(output, targets)  # make sure to do a full forward pass
-    loss.backward()
-    optimizer.second_step(zero_grad=True)
-    _loss = loss.item()
-    return _loss
+    # second forward-backward pass, make sure to do a full forward pass
+    # * a retried pass keeps the perturbation of the first step
+    loss = micro_batches.accumulate(model, criterion, features, targets, amp=amp)
+    optimizer.second_step(zero_grad=True, scaler=amp.scaler)
+    amp.scaler.update()
+    # * kept on the device, see LossMeter
+    return loss.detach()
 
 
 def run_training(args):
@@ -198,81 +349,13 @@ def run_training(args):
     device = args.device
     epochs = args.epochs
     experiment_folder = args.results_root
+    # batch transforms are applied on the device after transfer
+    transfer_func = transfer_features
+    amp = MixedPrecision(device, args.amp)
     os.makedirs(experiment_folder, exist_ok=True)
     ### DCASE
     if args.dataset == 'DCASE2020':
-        def get_scene_category(x):
-            if x in [
-                'airport',
-                'shopping_mall',
-                'metro_station'
-            ]:
-                return 'indoor'
-            elif x in [
-                'park',
-                'public_square',
-                'street_pedestrian',
-                'street_traffic'
-            ]:
-                return 'outdoor'
-            elif x in [
-                'bus',
-                'metro',
-                'tram'
-            ]:
-                return 'transportation'
-            else:
-                raise NotImplementedError(f'{x} not supported.')
-        #print("-----------------hi---------------")
-        df_train = pd.read_csv(
-            os.path.join(
-                args.data_root,
-                'evaluation_setup',
-                'fold1_train.csv'
-            ), sep='\t').set_index('filename')
-        df_train['scene_category'] = df_train['scene_label'].apply(
-            get_scene_category)
-        df_train['city'] = [
-            os.path.basename(x).split('-')[1]
-            for x in df_train.index.get_level_values('filename')
-        ]
-        df_train['device'] = [
-            os.path.basename(x).split('-')[-1].split('.')[0]
-            for x in df_train.index.get_level_values('filename')
-        ]
-        
-        df_dev = pd.read_csv(
-            os.path.join(
-                args.data_root,
-                'evaluation_setup',
-                'fold1_evaluate.csv'
-            ), sep='\t').set_index('filename')
-        df_dev['scene_category'] = df_dev['scene_label'].apply(get_scene_category)
-        df_dev['city'] = [
-            os.path.basename(x).split('-')[1]
-            for x in df_dev.index.get_level_values('filename')
-        ]
-        df_dev['device'] = [
-            os.path.basename(x).split('-')[-1].split('.')[0]
-            for x in df_dev.index.get_level_values('filename')
-        ]
-        
-        df_test = pd.read_csv(
-            os.path.join(
-                args.data_root,
-                'evaluation_setup',
-                'fold1_evaluate.csv'
-            ), sep='\t').set_index('filename')
-        df_test['scene_category'] = df_test['scene_label'].apply(
-            get_scene_category)
-        df_test['city'] = [
-            os.path.basename(x).split('-')[1]
-            for x in df_test.index.get_level_values('filename')
-        ]
-        df_test['device'] = [
-            os.path.basename(x).split('-')[-1].split('.')[0]
-            for x in df_test.index.get_level_values('filename')
-        ]
+        df_train, df_dev, df_test = load_dcase(args.data_root)
 
         if args.category is not None:
             df_train = df_train.loc[df_train['scene_category'] == args.category]
@@ -286,19 +369,33 @@ def run_training(args):
         encoder = LabelEncoder(
             list(df_train['scene_label'].unique()))
 
-        features = pd.read_csv(args.features).set_index('filename')
+        features = load_features(args.features)
 
         # * custom feature path support
-        if args.custom_feature_path is not None:
+        if args.custom_feature_path is not None and isinstance(features, pd.DataFrame):
             features = replace_file_path(
                 features, "features", args.custom_feature_path)
 
+        # * shared-memory feature cache (shared by runs and workers on a node)
+        if args.feature_cache is not None:
+            features = cache_features(
+                args.features,
+                features,
+                cache_root=args.feature_cache,
+                capacity=args.feature_cache_size,
+                feature_dir=args.feature_dir,
+                custom_feature_path=args.custom_feature_path
+            )
+
         db_args = {
             'features': features,
             'target_column': 'scene_label',
             'target_transform': encoder.encode,
-            'feature_dir': args.feature_dir
+            'feature_dir': args.feature_dir,
+            'stratify': ['scene_category', 'city', 'device']
         }
+        # arguments only used for the training set
+        train_args = {}
         
         if args.approach == 'cnn14':
             model = Cnn14(
@@ -330,10 +427,8 @@ def run_training(args):
         elif args.approach.startswith("efficientnet"):
             model = ModifiedEfficientNet(n_classes, scaling_type=args.approach, pretrained=args.pretrained)
             db_class = CachedDataset
-            # db_args['transform'] = transforms.Compose([GrayscaleToRGB(), transforms.ToTensor()])
-            db_args['transform'] = transforms.Compose([GrayscaleToRGB()])
-            # db_args['transform'] = torch.nn.Sequential(GrayscaleToRGB())
-            #db_args['transform'] = torch.nn.Sequential(torchvision.transforms.v2.Grayscale(num_output_channels=3))
+            # single-channel spectrograms are expanded to RGB on the device
+            transfer_func = FeatureTransfer(ExpandChannels(3))
 
             # model.to_yaml(os.path.join(experiment_folder, 'model.yaml'))
             criterion = torch.nn.CrossEntropyLoss()
@@ -375,15 +470,22 @@ def run_training(args):
             with open(os.path.join(experiment_folder, 'sincnet.yaml'), 'w') as fp:
                 yaml.dump(options, fp)
             db_class = WavDataset
-            df_train = fix_index(df_train, args.data_root)
-            df_dev = fix_index(df_dev, args.data_root)
-            df_test = fix_index(df_test, args.data_root)
-            db_args['transform'] = audtorch.transforms.RandomCrop(wlen)
+            if args.audio_cache is not None:
+                # decoded int16 audio, indexed by the filenames of the partitions
+                db_args['audio'] = load_audio(args.audio_cache, args.data_root)
+            else:
+                df_train = fix_index(df_train, args.data_root)
+                df_dev = fix_index(df_dev, args.data_root)
+                df_test = fix_index(df_test, args.data_root)
+            # dev/test use whole clips, see `Model.forward`
+            train_args['crop_length'] = wlen
+            train_args['crops_per_clip'] = args.crops_per_clip
             criterion = torch.nn.NLLLoss()
 
         train_dataset = db_class(
             df_train,
-            **db_args
+            **db_args,
+            **train_args
         )
         dev_dataset = db_class(
         df_dev,
@@ -413,13 +515,26 @@ def run_training(args):
         train_dev_dataset = torchvision.datasets.CIFAR10(root='./data', train=True,
                                             download=True, transform=transform)
         
-        generator1 = torch.Generator().manual_seed(42)
-        train_dataset, dev_dataset = torch.utils.data.random_split(train_dev_dataset, [1 - devel_percentage, devel_percentage], generator=generator1)
-        
-        
         test_dataset = torchvision.datasets.CIFAR10(root='./data', train=False,
                                        download=True, transform=transform)
 
+        if args.image_cache is not None:
+            # transform all images once instead of every epoch in the workers
+            resolution = '64x64' if args.approach in ["cnn10", "cnn14"] else '32x32'
+            train_dev_dataset = cache_images(
+                train_dev_dataset,
+                os.path.join(args.image_cache, 'cifar10_train_{}.pt'.format(resolution))
+            )
+            test_dataset = cache_images(
+                test_dataset,
+                os.path.join(args.image_cache, 'cifar10_test_{}.pt'.format(resolution))
+            )
+
+        # * split after caching, so that the subsets read the cached images
+        # * (the split only depends on the number of samples and the seed)
+        generator1 = torch.Generator().manual_seed(42)
+        train_dataset, dev_dataset = torch.utils.data.random_split(train_dev_dataset, [1 - devel_percentage, devel_percentage], generator=generator1)
+
         df_dev = get_df_from_dataset(dev_dataset)
         df_test = get_df_from_dataset(test_dataset)
         
@@ -465,8 +580,16 @@ def run_training(args):
             strict=False
             )
     
-    x, y = train_dataset[0]
-    x = np.expand_dims(x, axis=0)
+    # CachedDataset fetches whole batches through __getitems__
+    collate_fn = collate_batch
+    # sincnet evaluates whole clips of any length, windows are cut on the device
+    eval_collate_fn = collate_windows if args.approach == 'sincnet' else collate_fn
+    # several crops per clip are flattened into the batch
+    train_collate_fn = collate_crops if getattr(
+        train_dataset, 'crops_per_clip', 1) > 1 else collate_fn
+
+    x, y = train_collate_fn([train_dataset[0]])
+    x = transfer_func(x, 'cpu')
     print(x.shape)
     summary(model=model, 
         input_size=(x.shape), # make sure this is "input_size", not "input_shape"
@@ -478,36 +601,56 @@ def run_training(args):
     # print("-" * 50)
     # personalized_plot_model(model)
 
-    if args.approach == 'sincnet':
-        db_args.pop('transform')
-    
     # create DataLoaders
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset,
-        shuffle=True,
-        batch_size=args.batch_size,
-        num_workers=4,
-        generator=gen_seed
-    )
+    if args.device_loader:
+        if args.dataset != 'CIFAR10' or args.image_cache is None:
+            raise ValueError('--device-loader is only supported for CIFAR10 with --image-cache.')
+        train_loader = DeviceLoader(
+            train_dataset,
+            batch_size=args.batch_size,
+            shuffle=True,
+            device=device,
+            generator=gen_seed
+        )
+        dev_loader = DeviceLoader(
+            dev_dataset,
+            batch_size=args.batch_size,
+            device=device
+        )
+        test_loader = DeviceLoader(
+            test_dataset,
+            batch_size=args.batch_size,
+            device=device
+        )
+    else:
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset,
+            shuffle=True,
+            batch_size=args.batch_size,
+            num_workers=4,
+            generator=gen_seed,
+            collate_fn=train_collate_fn
+        )
 
-    dev_loader = torch.utils.data.DataLoader(
-        dev_dataset,
-        shuffle=False,
-        batch_size=1 if args.approach == 'sincnet' else args.batch_size,
-        num_workers=4,
-        generator=gen_seed
-    )
-    
+        dev_loader = torch.utils.data.DataLoader(
+            dev_dataset,
+            shuffle=False,
+            batch_size=args.batch_size,
+            num_workers=4,
+            generator=gen_seed,
+            collate_fn=eval_collate_fn
+        )
 
-    # df_dev = pd.DataFrame(dev_dataset.dataset)
+        # df_dev = pd.DataFrame(dev_dataset.dataset)
 
-    test_loader = torch.utils.data.DataLoader(
-        test_dataset,
-        shuffle=False,
-        batch_size=1 if args.approach == 'sincnet' else args.batch_size,
-        num_workers=4,
-        generator=gen_seed
-    )
+        test_loader = torch.utils.data.DataLoader(
+            test_dataset,
+            shuffle=False,
+            batch_size=args.batch_size,
+            num_workers=4,
+            generator=gen_seed,
+            collate_fn=eval_collate_fn
+        )
 
     accuracy_history = []
     uar_history = []
@@ -568,6 +711,11 @@ def run_training(args):
         best_epoch = 0
         best_state = None
         best_results = None
+        # * epoch states and outputs are written in the background
+        checkpoints = CheckpointWriter(
+            keep_last=args.keep_last,
+            keep_every=args.keep_every
+        )
 
         # accuracy_history = []
         # uar_history = []
@@ -575,7 +723,44 @@ def run_training(args):
         # train_loss_history = []
         # valid_loss_history = []
 
-        for epoch in range(epochs):
+        # * full state of the latest complete epoch, training continues from there
+        resume_path = os.path.join(experiment_folder, 'training_state.pth.tar')
+        start_epoch = 0
+        if os.path.exists(resume_path) and isinstance(optimizer, ModuleWrapper):
+            print('gdtuo optimizers can not be resumed, training from scratch')
+        elif os.path.exists(resume_path):
+            resume = torch.load(resume_path, map_location='cpu')
+            start_epoch = resume['epoch']
+            model.load_state_dict(resume['model'])
+            model.to(device)
+            optimizer.load_state_dict(resume['optimizer'])
+            if isinstance(sheduler, list):
+                for sh, state in zip(sheduler, resume['sheduler']):
+                    sh.load_state_dict(state)
+            elif sheduler is not None:
+                sheduler.load_state_dict(resume['sheduler'])
+            amp.scaler.load_state_dict(resume['scaler'])
+            set_rng_state(resume['rng'], gen_seed)
+            accuracy_history.extend(resume['history']['ACC'])
+            uar_history.extend(resume['history']['UAR'])
+            f1_history.extend(resume['history']['F1'])
+            train_loss_history.extend(resume['history']['train_loss'])
+            valid_loss_history.extend(resume['history']['val_loss'])
+            max_metric = resume['max_metric']
+            best_epoch = resume['best_epoch']
+            best_results = resume['best_results']
+            best_state = torch.load(resume['best_state'], map_location='cpu')
+            # epoch states left by the retention policy stay subject to it
+            for epoch in range(1, start_epoch + 1):
+                path = os.path.join(experiment_folder, f'Epoch_{epoch}', 'state.pth.tar')
+                if os.path.exists(path):
+                    checkpoints.track(path, epoch, is_best=epoch == best_epoch + 1)
+            epoch_folder = os.path.join(experiment_folder, f'Epoch_{start_epoch}')
+            print(f'Resuming training after epoch {start_epoch}')
+
+        micro_batches = MicroBatches(args.micro_batch_size)
+        fisher = FisherSampler(args.fisher, args.fisher_samples)
+        for epoch in range(start_epoch, epochs):
             model.to(device)
             model.train()
             epoch_folder = os.path.join(
@@ -586,7 +771,8 @@ def run_training(args):
 
             if "train_timer" in args:
                 args.train_timer.start()
-            _loss_history = []
+            # * losses and NaN checks stay on the device until the next log interval
+            meter = LossMeter(device)
             for index, (features, targets) in tqdm.tqdm(
                 enumerate(train_loader),
                 desc=f'Epoch {epoch}',
@@ -594,30 +780,38 @@ def run_training(args):
                 disable=args.disable_progress_bar
             ):
 
-                if (features != features).sum():
-                    raise ValueError(features)
+                meter.check_features(features)
 
                 if isinstance(optimizer, ModuleWrapper):
                     loss = train_step_gdtuo(
-                        model, optimizer, criterion, features, targets, device)
+                        model, optimizer, criterion, features, targets, device,
+                        transfer_func=transfer_func, amp=amp)
                 elif isinstance(optimizer, (KFACOptimizer, EKFACOptimizer)):
                     loss = train_step_kfac(
-                        model, optimizer, criterion, features, targets, device, epoch+1, index+1)
-                elif isinstance(optimizer, SAM):
-                    loss = train_step_SAM(
-                        model, optimizer, criterion, features, targets, device)
+                        model, optimizer, criterion, features, targets, device, epoch+1, index+1,
+                        transfer_func=transfer_func, amp=amp, fisher=fisher)
                 else:
-                    loss = train_step_normal(
-                        model, optimizer, criterion, features, targets, device)
+                    # * SAM and base optimizers accumulate gradients over micro-batches,
+                    # * which are halved whenever the GPU runs out of memory
+                    train_step = train_step_SAM if isinstance(optimizer, SAM) else train_step_normal
+                    loss = train_step(
+                        model, optimizer, criterion, features, targets, device,
+                        transfer_func=transfer_func, amp=amp, micro_batches=micro_batches)
+                meter.update(loss)
                 if index % 50 == 0:
+                    meter.check()
                     writer.add_scalar(
                         'Loss',
-                        loss,
+                        loss.item(),
                         global_step=epoch * len(train_loader) + index
                     )
-                _loss_history.append(loss)
                 
-            train_loss = sum(_loss_history)/len(_loss_history)
+            train_loss = meter.mean()
+            if isinstance(optimizer, SAM):
+                # * forward-backward passes per step, 1 for the base optimizer
+                writer.add_scalar('SAM/passes_per_step', optimizer.cost(), epoch + 1)
+                print(f'SAM passes per step at epoch {epoch+1}: {optimizer.cost():.3f}')
+                optimizer.reset_cost()
             # print(train_loss)
             if "train_timer" in args:
                 args.train_timer.stop()
@@ -637,7 +831,7 @@ def run_training(args):
                 model,
                 device,
                 dev_loader,
-                transfer_features,
+                transfer_func,
                 args.disable_progress_bar,
                 criterion
             )
@@ -648,22 +842,32 @@ def run_training(args):
             )
             results_df['predictions'] = results_df['predictions'].apply(
                 encoder.decode)
-            results_df.reset_index().to_csv(os.path.join(epoch_folder, 'dev.csv'), index=False)
-            np.save(os.path.join(epoch_folder, 'outputs.npy'), outputs)
+            checkpoints.submit(
+                results_df.reset_index().to_csv,
+                os.path.join(epoch_folder, 'dev.csv'),
+                index=False
+            )
+            checkpoints.submit(
+                np.save, os.path.join(epoch_folder, 'outputs.npy'), outputs)
         
             # print(results_df)
             if args.dataset == "DCASE2020":
                 task = 'scene_label'
                 stratify = ['scene_category', 'city', 'device']
+                # * strata are integer coded once by the dataset
+                strata, strata_labels = dev_dataset.strata, dev_dataset.strata_labels
             else:
                 task = "label"
                 stratify = []
+                strata, strata_labels = None, None
             logging_results = disaggregated_evaluation(
                 results_df,
                 df_dev,
                 task,
                 stratify,
-                'categorical'
+                'categorical',
+                strata=strata,
+                strata_labels=strata_labels
             )
 
             with open(os.path.join(epoch_folder, 'dev.yaml'), 'w') as fp:
@@ -675,8 +879,16 @@ def run_training(args):
                     (epoch + 1) * len(train_loader)
                 )
 
-            torch.save(model.cpu().state_dict(), os.path.join(
-                epoch_folder, 'state.pth.tar'))
+            is_best = results['ACC'] > max_metric
+            # * snapshot without moving the model, copies are independent of the live weights
+            # * old states are only removed once the resume file no longer refers to them
+            state = checkpoints.save_state(
+                model.state_dict(),
+                os.path.join(epoch_folder, 'state.pth.tar'),
+                epoch + 1,
+                is_best=is_best,
+                retain=False
+            )
             results["train_loss"] = train_loss
             results["val_loss"] = valid_loss
             
@@ -687,12 +899,37 @@ def run_training(args):
             f1_history.append(results["F1"])
             train_loss_history.append(train_loss)
             valid_loss_history.append(valid_loss)
-            if results['ACC'] > max_metric:
+            if is_best:
                 max_metric = results['ACC']
                 best_epoch = epoch
-                best_state = model.cpu().state_dict()
+                best_state = state
                 best_results = results.copy()
 
+            if not isinstance(optimizer, ModuleWrapper):
+                checkpoints.write({
+                    'epoch': epoch + 1,
+                    'model': model.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'sheduler': [sh.state_dict() for sh in sheduler]
+                    if isinstance(sheduler, list)
+                    else (sheduler.state_dict() if sheduler is not None else None),
+                    'scaler': amp.scaler.state_dict(),
+                    'rng': rng_state(gen_seed),
+                    'history': {
+                        'ACC': accuracy_history,
+                        'UAR': uar_history,
+                        'F1': f1_history,
+                        'train_loss': train_loss_history,
+                        'val_loss': valid_loss_history
+                    },
+                    'max_metric': max_metric,
+                    'best_epoch': best_epoch,
+                    'best_results': best_results,
+                    'best_state': os.path.join(
+                        experiment_folder, f'Epoch_{best_epoch+1}', 'state.pth.tar')
+                }, resume_path)
+            checkpoints.retain()
+
             # plateau_scheduler.step(results['ACC'])
             if "valid_timer" in args:
                 args.valid_timer.stop()
@@ -700,9 +937,10 @@ def run_training(args):
                 model,
                 device,
                 train_loader,
-                transfer_features,
+                transfer_func,
                 args.disable_progress_bar,
-                criterion
+                criterion,
+                store_outputs=False
             )
         print(f'Final Train results:\n {yaml.dump(train_results)}')
         print(f'Final Train loss:\n {yaml.dump(train_loss)}')
@@ -720,6 +958,8 @@ def run_training(args):
         with open(os.path.join(experiment_folder, 'dev.yaml'), 'w') as fp:
             yaml.dump(best_results, fp)
         writer.close()
+        # * all snapshots (including best_state) are complete afterwards
+        checkpoints.close()
     else:
         best_state = torch.load(os.path.join(
             experiment_folder, 'state.pth.tar'))
@@ -734,14 +974,19 @@ def run_training(args):
     if not os.path.exists(os.path.join(experiment_folder, 'test_holistic.yaml')):
     # if True:
         model.load_state_dict(best_state)
+        # * outputs are written to outputs.npy batch by batch
         test_results, targets, predictions, outputs, valid_loss = evaluate_categorical(
-            model, device, test_loader, transfer_features, args.disable_progress_bar, criterion)
+            model, device, test_loader, transfer_func, args.disable_progress_bar, criterion,
+            outputs_path=os.path.join(experiment_folder, 'outputs.npy'),
+            outputs_dtype=np.float16 if args.half_outputs else np.float32)
         print(f'Best test results:\n{yaml.dump(test_results)}')
         torch.save(best_state, os.path.join(
             experiment_folder, 'state.pth.tar'))
+        # * the final state replaces the resumable one
+        if os.path.exists(os.path.join(experiment_folder, 'training_state.pth.tar')):
+            os.remove(os.path.join(experiment_folder, 'training_state.pth.tar'))
         np.save(os.path.join(experiment_folder, 'targets.npy'), targets)
-        np.save(os.path.join(experiment_folder, 'outputs.npy'), outputs)
-        np.save(os.path.join(experiment_folder, 'predictions.npy'), outputs)
+        np.save(os.path.join(experiment_folder, 'predictions.npy'), predictions)
         results_df = pd.DataFrame(
             index=df_test.index,
             data=predictions,
@@ -757,15 +1002,20 @@ def run_training(args):
             if args.dataset == "DCASE2020":
                 task = 'scene_label'
                 stratify = ['scene_category', 'city', 'device']
+                # * strata are integer coded once by the dataset
+                strata, strata_labels = test_dataset.strata, test_dataset.strata_labels
             else:
                 task = "label"
                 stratify = []
+                strata, strata_labels = None, None
             logging_results = disaggregated_evaluation(
                 results_df,
                 df_test,
                 task,
                 stratify,
-                'categorical'
+                'categorical',
+                strata=strata,
+                strata_labels=strata_labels
             )
             with open(os.path.join(experiment_folder, 'test_holistic.yaml'), 'w') as fp:
                 yaml.dump(logging_results, fp)
@@ -790,7 +1040,7 @@ if __name__ == '__main__':
     )
     parser.add_argument(
         '--features',
-        help='Path to features',
+        help='Path to features.csv or to a packed feature store (see feature_store.py)',
         required=True
     )
     
@@ -858,6 +1108,95 @@ if __name__ == '__main__':
         required=False
     )
 
+    parser.add_argument(
+        '--feature-cache',
+        default=None,
+        help='Pack features into this shared-memory folder (e.g. /dev/shm/sharpnessasc) '
+             'and load them from there'
+    )
+
+    parser.add_argument(
+        '--feature-cache-size',
+        default=None,
+        type=float,
+        help='Size of the feature cache in GB, least recently used feature sets are evicted'
+    )
+
+    parser.add_argument(
+        '--audio-cache',
+        default=None,
+        help='Decoded int16 audio store for sincnet (packed from --data-root if missing)'
+    )
+
+    parser.add_argument(
+        '--crops-per-clip',
+        default=1,
+        type=int,
+        help='Random crops drawn per clip and fetch for sincnet (multiplies the batch size)'
+    )
+
+    parser.add_argument(
+        '--keep-last',
+        default=None,
+        type=int,
+        help='Keep the states of the last K epochs only (the best state is always kept)'
+    )
+
+    parser.add_argument(
+        '--keep-every',
+        default=None,
+        type=int,
+        help='Additionally keep the state of every N-th epoch'
+    )
+
+    parser.add_argument(
+        '--micro-batch-size',
+        default=None,
+        type=int,
+        help='Accumulate the gradients of each batch over micro-batches of this size, '
+             'halved automatically when running out of GPU memory'
+    )
+
+    parser.add_argument(
+        '--half-outputs',
+        action='store_true',
+        help='Write the test outputs (outputs.npy) as float16'
+    )
+
+    parser.add_argument(
+        '--fisher',
+        default='sampled',
+        choices=['sampled', 'empirical'],
+        help='Statistics of (E)KFAC from targets sampled from the predictions '
+             'or from the training targets'
+    )
+
+    parser.add_argument(
+        '--fisher-samples',
+        default=1,
+        type=int,
+        help='Targets sampled per input for the statistics of (E)KFAC'
+    )
+
+    parser.add_argument(
+        '--amp',
+        default=None,
+        choices=['fp16', 'bf16'],
+        help='Train with automatic mixed precision'
+    )
+
+    parser.add_argument(
+        '--image-cache',
+        default=None,
+        help='Folder to store transformed CIFAR10 images in (created once, reused by later runs)'
+    )
+
+    parser.add_argument(
+        '--device-loader',
+        action='store_true',
+        help='Keep the cached CIFAR10 images on the device and batch them there (no DataLoader workers)'
+    )
+
     parser.add_argument(
         '--disable-progress-bar',
         default=False,
@@ -12,6 +12,122 @@ import numpy as np
 def transfer_features(features, device):
     return features.to(device).float()
 
+
+class FeatureTransfer(object):
+    r"""Transfer function applying batch transforms after the device copy.
+
+    Drop-in replacement for :func:`transfer_features`
+    which keeps per-sample transforms out of the DataLoader workers.
+
+    Args:
+        transforms: callables applied in order to the batch on the device
+    """
+
+    def __init__(self, *transforms):
+        self.transforms = transforms
+
+    def __call__(self, features, device):
+        features = transfer_features(features, device)
+        for transform in self.transforms:
+            features = transform(features)
+        return features
+
+
+class ExpandChannels(object):
+    r"""Expands grayscale spectrograms to RGB on the device.
+
+    Repeats a single channel as a broadcast view,
+    so no copy is made.
+    Expects batches of shape ``(batch, time, freq)``
+    or ``(batch, 1, time, freq)``.
+    """
+
+    def __init__(self, channels=3):
+        self.channels = channels
+
+    def __call__(self, features):
+        if features.dim() == 3:
+            features = features.unsqueeze(1)
+        return features.expand(-1, self.channels, -1, -1)
+
+
+class MixedPrecision(object):
+    r"""Autocast context and gradient scaler shared by the train steps.
+
+    The scaler is only enabled for fp16 on CUDA,
+    otherwise it passes losses and optimizer steps through unchanged.
+
+    Args:
+        device: device the model is trained on
+        dtype: ``'fp16'``, ``'bf16'`` or ``None`` to train in fp32
+    """
+    DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+    def __init__(self, device='cpu', dtype=None):
+        self.device_type = torch.device(device).type
+        self.dtype = self.DTYPES[dtype] if dtype is not None else None
+        self.enabled = self.dtype is not None
+        self.scaler = torch.cuda.amp.GradScaler(
+            enabled=self.dtype == torch.float16 and self.device_type == 'cuda')
+
+    def autocast(self):
+        return torch.autocast(
+            self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+
+FULL_PRECISION = MixedPrecision()
+
+
+class LossMeter(object):
+    r"""Training loss and NaN checks accumulated on the device.
+
+    Nothing is copied to the host before :meth:`check` or :meth:`mean`,
+    so the training loop does not synchronize with the GPU every batch.
+
+    Args:
+        device: device the losses are computed on
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.count = 0
+        self.loss_sum = torch.zeros((), device=device)
+        self.nonfinite_losses = torch.zeros((), dtype=torch.int64, device=device)
+        self.nan_features = torch.zeros((), dtype=torch.int64, device=device)
+        # batches still on the CPU are counted there
+        self.host_nan_features = 0
+
+    def check_features(self, features):
+        if not torch.is_tensor(features):
+            return
+        nan_features = torch.isnan(features).sum()
+        if nan_features.device.type == 'cpu':
+            self.host_nan_features += int(nan_features)
+        else:
+            self.nan_features += nan_features.to(self.nan_features.device)
+
+    def update(self, loss):
+        loss = loss.detach().float()
+        self.loss_sum += loss
+        self.nonfinite_losses += (~torch.isfinite(loss)).long()
+        self.count += 1
+
+    def check(self):
+        r"""Raise if NaN features or non-finite losses occurred so far."""
+        nan_features, nonfinite_losses = torch.stack(
+            [self.nan_features, self.nonfinite_losses]).tolist()
+        nan_features += self.host_nan_features
+        if nan_features > 0:
+            raise ValueError(f'{nan_features} NaN values in features.')
+        if nonfinite_losses > 0:
+            raise FloatingPointError(f'{nonfinite_losses} non-finite training losses.')
+
+    def mean(self):
+        r"""Mean loss over all updates (after a final :meth:`check`)."""
+        self.check()
+        return self.loss_sum.item() / max(self.count, 1)
+
+
 def get_output_dim(model):
     for module in reversed(list(model.modules())):
         if isinstance(module, torch.nn.Linear):
@@ -20,58 +136,159 @@ def get_output_dim(model):
             break
     return output_dim
 
+def get_targets(dataset):
+    r"""Targets of all samples of ``dataset`` without loading the samples.
+
+    Reads ``targets`` of the dataset (e.g. torchvision datasets)
+    and follows the indices of (nested) subsets.
+    Falls back to iterating the dataset.
+    """
+    if isinstance(dataset, torch.utils.data.Subset):
+        return get_targets(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    if hasattr(dataset, 'targets'):
+        return np.asarray(dataset.targets)
+    return np.asarray([dataset[i][1] for i in range(len(dataset))])
+
+
 def get_df_from_dataset(dataset):
-    data = []
-    for i in range(len(dataset)):
-        image, label = dataset[i]
-        # image = image.numpy().flatten()  # Flatten the image tensor
-        data.append((image, label))
-    data_dict = {'image': [], 'label': []}
-    for image, label in data:
-        data_dict['image'].append(image)
-        data_dict['label'].append(label)
-    df = pd.DataFrame(data_dict)
-    return df
-
-
-def evaluate_categorical(model, device, loader, transfer_func, disable, criterion):
-    metrics = {
-        'UAR': audmetric.unweighted_average_recall,
-        'ACC': audmetric.accuracy,
-        'F1': audmetric.unweighted_average_fscore
-    }
+    r"""Dataframe with the label of every sample of ``dataset``."""
+    return pd.DataFrame({'label': get_targets(dataset)})
+
+
+def categorical_metrics(matrix):
+    r"""UAR, ACC and F1 of one or several confusion matrices.
+
+    Rows of ``matrix`` are true classes, columns predicted classes,
+    leading dimensions (e.g. one matrix per stratum) are kept.
+    Matches audmetric: averages only run over classes
+    present in truth or prediction
+    and zero divisions count as zero.
+
+    Args:
+        matrix: array of shape ``(..., classes, classes)``
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    hits = np.diagonal(matrix, axis1=-2, axis2=-1)
+    truth = matrix.sum(-1)
+    predicted = matrix.sum(-2)
+    present = (truth + predicted) > 0
+    recall = np.divide(hits, truth, out=np.zeros_like(hits), where=truth > 0)
+    precision = np.divide(hits, predicted, out=np.zeros_like(hits), where=predicted > 0)
+    fscore = np.divide(
+        2 * precision * recall,
+        precision + recall,
+        out=np.zeros_like(hits),
+        where=precision * recall > 0
+    )
+    classes = present.sum(-1)
+    # empty matrices give NaN like audmetric
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {
+            'UAR': (recall * present).sum(-1) / classes,
+            'ACC': hits.sum(-1) / truth.sum(-1),
+            'F1': (fscore * present).sum(-1) / classes
+        }
+
 
+class ConfusionMeter(object):
+    r"""Confusion matrix and loss sum accumulated on the device.
+
+    Args:
+        num_classes: number of model outputs
+        device: device the outputs are computed on
+    """
+
+    def __init__(self, num_classes, device):
+        self.num_classes = num_classes
+        self.count = 0
+        self.matrix = torch.zeros(
+            (num_classes, num_classes), dtype=torch.int64, device=device)
+        self.loss_sum = torch.zeros((), device=device)
+
+    def update(self, outputs, targets, loss=None):
+        r"""Add a batch of ``outputs`` and its (mean) ``loss``."""
+        predictions = outputs.argmax(dim=1)
+        self.matrix += torch.bincount(
+            targets * self.num_classes + predictions,
+            minlength=self.num_classes ** 2
+        ).view(self.num_classes, self.num_classes)
+        if loss is not None:
+            self.loss_sum += loss.detach().float() * len(targets)
+        self.count += len(targets)
+        return predictions
+
+    def metrics(self):
+        return {
+            key: float(value)
+            for key, value in categorical_metrics(self.matrix.cpu().numpy()).items()
+        }
+
+    def loss(self):
+        return self.loss_sum.item() / max(self.count, 1)
+
+
+def evaluate_categorical(
+    model,
+    device,
+    loader,
+    transfer_func,
+    disable,
+    criterion,
+    store_outputs=True,
+    outputs_path=None,
+    outputs_dtype=np.float32
+):
+    r"""Evaluate ``model`` on ``loader`` batch by batch.
+
+    Metrics and loss are accumulated on the device
+    (see :class:`ConfusionMeter`),
+    only targets and predictions are gathered for all samples.
+
+    Args:
+        store_outputs: also return the outputs of all samples,
+            otherwise ``None`` is returned for them
+        outputs_path: write the outputs as ``.npy`` memmap
+            to this file instead of keeping them in memory
+        outputs_dtype: data type of the memmap,
+            e.g. ``np.float16`` to halve its size
+    """
     model.to(device)
     model.eval()
-    #print("Getting the output dims")
-    output_dim = get_output_dim(model)
-    #print(output_dim)
-    # outputs = torch.zeros((len(loader.dataset), model.output_dim))
-    outputs = torch.zeros((len(loader.dataset), output_dim))
-    targets = torch.zeros(len(loader.dataset))
+    meter = ConfusionMeter(get_output_dim(model), device)
+    targets = []
+    predictions = []
+    outputs = [] if store_outputs else None
+    if store_outputs and outputs_path is not None:
+        outputs = np.lib.format.open_memmap(
+            outputs_path,
+            mode='w+',
+            dtype=outputs_dtype,
+            shape=(len(loader.dataset), meter.num_classes)
+        )
     with torch.no_grad():
-        for index, (features, target) in tqdm.tqdm(
-            enumerate(loader),
+        for features, target in tqdm.tqdm(
+            loader,
             desc='Batch',
             total=len(loader),
             disable=disable,
         ):
-            start_index = index * loader.batch_size
-            end_index = (index + 1) * loader.batch_size
-            if end_index > len(loader.dataset):
-                end_index = len(loader.dataset)
-            outputs[start_index:end_index, :] = model(
-                transfer_func(features, device))
-            targets[start_index:end_index] = target
-    loss = criterion(outputs, targets.type(torch.LongTensor))
-    targets = targets.numpy()
-    outputs = outputs.cpu()
-    predictions = outputs.argmax(dim=1).numpy()
-    outputs = outputs.numpy()
-    return {
-        key: metrics[key](targets, predictions)
-        for key in metrics.keys()
-    }, targets, predictions, outputs, loss.item()
+            output = model(transfer_func(features, device))
+            target = target.to(device).long()
+            start = meter.count
+            prediction = meter.update(output, target, criterion(output, target))
+            if isinstance(outputs, list):
+                outputs.append(output)
+            elif outputs is not None:
+                outputs[start:meter.count] = output.cpu().numpy()
+            targets.append(target)
+            predictions.append(prediction)
+    targets = torch.cat(targets).cpu().numpy()
+    predictions = torch.cat(predictions).cpu().numpy()
+    if isinstance(outputs, list):
+        outputs = torch.cat(outputs).float().cpu().numpy()
+    elif outputs is not None:
+        outputs.flush()
+    return meter.metrics(), targets, predictions, outputs, meter.loss()
 
 
 class LabelEncoder(audobject.Object):
@@ -90,30 +307,21 @@ class LabelEncoder(audobject.Object):
         return self.inverse_map[x]
 
 
-def disaggregated_evaluation(df, groundtruth, task, stratify, evaluation_type: str = 'regression'):
-    if evaluation_type == 'regression':
-        metrics = {
-            'CC': audmetric.pearson_cc,
-            'CCC': audmetric.concordance_cc,
-            'MSE': audmetric.mean_squared_error,
-            'MAE': audmetric.mean_absolute_error
-        }
-    elif evaluation_type == 'categorical':
-        metrics = {
-            'UAR': audmetric.unweighted_average_recall,
-            'ACC': audmetric.accuracy,
-            'F1': audmetric.unweighted_average_fscore
-        }
-    else:
+def disaggregated_evaluation(df, groundtruth, task, stratify, evaluation_type: str = 'regression', strata=None, strata_labels=None):
+    if evaluation_type == 'categorical':
+        return disaggregated_categorical(df, groundtruth, task, stratify, strata, strata_labels)
+    elif evaluation_type != 'regression':
         raise NotImplementedError(evaluation_type)
+    metrics = {
+        'CC': audmetric.pearson_cc,
+        'CCC': audmetric.concordance_cc,
+        'MSE': audmetric.mean_squared_error,
+        'MAE': audmetric.mean_absolute_error
+    }
 
     df = df.reindex(groundtruth.index)
     results = {key: {} for key in metrics.keys()}
     for key in metrics.keys():
-        # print(df)
-        # print("groundtruth")
-        # print(groundtruth.shape)
-        # print(groundtruth)
         results[key]['all'] = metrics[key](
             groundtruth[task],
             df['predictions']
@@ -129,27 +337,54 @@ def disaggregated_evaluation(df, groundtruth, task, stratify, evaluation_type: s
 
     return results
 
-    
 
-class GrayscaleToRGB(object):
-    def __call__(self, image):
-        # Convert tensor to numpy array and adjust data type if needed
-        # print(image.shape)
-        if isinstance(image, torch.Tensor):
-            image = image.cpu().numpy()
-        image = image.astype(np.float32)
-
-        # Check if the input is already a grayscale image
-        if len(image.shape) == 2:
-            image = np.expand_dims(image, axis=0)
-
-        # Convert grayscale image to RGB
-        image_rgb = np.repeat(image, 3, axis=0)
-        # print(image_rgb.shape)
-        # Convert the RGB image to a tensor
-        # image_tensor = torch.from_numpy(image_rgb)
-        # print(image_tensor.shape)
-        return image_rgb
+def disaggregated_categorical(df, groundtruth, task, stratify, strata=None, strata_labels=None):
+    r"""UAR, ACC and F1 overall and for every stratum.
+
+    Labels and strata are integer coded once,
+    the confusion matrices of all groups are counted in a single
+    bincount pass and all metrics are computed from them
+    (see :func:`categorical_metrics`).
+    Returns the layout of :func:`disaggregated_evaluation`.
+
+    Args:
+        df: dataframe with a ``predictions`` column
+        groundtruth: dataframe with ``task`` and ``stratify`` columns
+        task: column of the true labels
+        stratify: columns defining strata
+        strata: integer codes of the ``stratify`` columns in the order of ``groundtruth``,
+            e.g. ``strata`` of :class:`datasets.CachedDataset`,
+            columns missing here are factorized from ``groundtruth``
+        strata_labels: values of the codes in ``strata``
+    """
+    predictions = df['predictions'].reindex(groundtruth.index).to_numpy()
+    codes, labels = pd.factorize(
+        np.concatenate([groundtruth[task].to_numpy(), predictions]))
+    num_classes = len(labels)
+    truth, predictions = np.split(codes.astype(np.int64), 2)
+
+    # group 0 holds all samples, followed by the values of every stratifier
+    groups = [np.zeros(len(truth), dtype=np.int64)]
+    names = ['all']
+    for stratifier in stratify:
+        if strata is not None and stratifier in strata:
+            group, values = strata[stratifier], strata_labels[stratifier]
+        else:
+            group, values = pd.factorize(groundtruth[stratifier])
+        groups.append(group.astype(np.int64) + len(names))
+        names.extend(values)
+    cells = truth * num_classes + predictions
+    matrices = np.bincount(
+        np.concatenate(groups) * num_classes ** 2 + np.tile(cells, len(groups)),
+        minlength=len(names) * num_classes ** 2
+    ).reshape(len(names), num_classes, num_classes)
+
+    metrics = categorical_metrics(matrices)
+    return {
+        key: {name: float(value) for name, value in zip(names, values)}
+        for key, values in metrics.items()
+    }
+
 
 #########################################################################################################
 ### Util Functions from https://github.com/tml-epfl/sharpness-vs-generalization                       ###